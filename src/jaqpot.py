@@ -1,21 +1,35 @@
 #!/usr/bin/env python
 
 import argparse
+import ast
+import glob
+import gzip
+import heapq
+import math
 import os
 import logging
+import operator
+import re
+import resource
+import tempfile
+import time
 
 from pathlib import Path
 
+import joblib
+
+from rdkit import Chem
+
 from jaqpotpy.models import MolecularModel
 from dm_job_utilities.dm_log import DmLog
 
 from urllib.request import urlretrieve
-from urllib.error import HTTPError
+from urllib.error import URLError
 from urllib.parse import urlparse
 from urllib.parse import urljoin
 
 import rdkit_utils
-from utils import read_delimiter
+from utils import read_delimiter, calc_geometric_mean
 
 logging.basicConfig(level=logging.INFO)
 
@@ -44,12 +58,52 @@ models_meta = {
     "pgp": "PGP model",
  }
 
+# where the models are loaded from if neither --model-base-path nor BASE_MODEL_URL are set
+default_model_base_path = "https://im-jaqpot-models.s3.eu-central-1.amazonaws.com/"
+
+# file extensions picked up when a directory is given as input
+input_extensions = ('.smi', '.smi.gz', '.txt', '.txt.gz', '.sdf', '.sdf.gz', '.sd', '.sd.gz')
+
+# filters for the Cascade, e.g. hERG_model_Prediction == 0
+filter_pattern = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$')
+filter_ops = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+# functions that can be used in the score expressions of the Ranker
+score_functions = {
+    'gmean': lambda *values: calc_geometric_mean(values),
+    'min': min,
+    'max': max,
+    'abs': abs,
+    'log10': math.log10,
+    'exp': math.exp,
+}
+
+# the syntax allowed in the score expressions. Calls are further restricted to the score_functions
+score_nodes = (
+    ast.Expression, ast.Name, ast.Load, ast.Constant, ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp, ast.Call,
+    ast.operator, ast.unaryop, ast.cmpop, ast.boolop,
+)
+
+# molecule the models are run on to find their output columns
+probe_smiles = 'CCO'
 
+# name of the column holding the score when ranking
+score_prop_name = "Score"
+
+# name of the column holding the input file name when multiple inputs are written to one output
+source_prop_name = "source_file"
 
 
 def run(
     model_ids: list,
-    input_filename: str,
+    input_filename,
     output_filename: str,
     delimiter: str = "\t",
     read_header: bool = True,
@@ -58,7 +112,34 @@ def run(
     sdf_read_records: int = 100,
     reporting_interval: int = 100,
     model_base_path: str = "",
+    legacy_charges: bool = False,
+    batch_size: int = 1000,
+    estimate_only: bool = False,
+    estimate_sample_size: int = 200,
+    mmap_models: bool = False,
+    model_cache_dir: str = None,
+    filters: list = None,
+    cascade_mode: str = "drop",
+    append: bool = False,
+    score: str = None,
+    top_k: int = None,
+    threshold: float = None,
+    rejects_filename: str = None,
+    validate_smiles: bool = False,
 ):
+    """
+    Run the predictions.
+    :param input_filename: Input file, or a list of files, glob patterns or directories
+    :param output_filename: Output file. If it contains {name} one output is written for each input, {name} being
+                            replaced with the input file name without extension. Otherwise all results are written to
+                            the one file with an extra source_file column when there are multiple inputs.
+    :param estimate_only: Don't run the predictions, just estimate the time, memory, output size and cost
+    :param estimate_sample_size: The number of records to sample for the estimate
+    :param mmap_models: Load the models from the memory mappable format, creating it if needed
+    :param model_cache_dir: Directory for the memory mappable models (see load_models)
+    :param filters: Filter expressions such as "hERG_model_Prediction == 0" (see Cascade)
+    :param cascade_mode: What to do with molecules that fail a filter, drop them or write empty values
+    """
 
     logging.info('read_header: %s', read_header)
     logging.info('write_header: %s', write_header)
@@ -68,31 +149,325 @@ def run(
     # special processing of delimiter to allow it to be set as a name
     delimiter = read_delimiter(delimiter)
 
-    model_base_path = "https://im-jaqpot-models.s3.eu-central-1.amazonaws.com"
-    # if not given, try to extract from env variable
+    input_filenames = expand_inputs(input_filename)
+    if not input_filenames:
+        DmLog.emit_event("No input files found!")
+        return
+    logging.info('input files: %s', input_filenames)
+
+    if append:
+        # the header is needed to know which predictions are present
+        read_header = True
+        present = existing_model_ids(
+            input_filenames, model_ids,
+            delimiter=delimiter,
+            id_column=id_column,
+            sdf_read_records=sdf_read_records,
+        )
+        if present:
+            DmLog.emit_event("Predictions already present for", ", ".join(sorted(present)))
+        model_ids = [model_id for model_id in model_ids if model_id not in present]
+        if not model_ids:
+            DmLog.emit_event("No models to add!")
+            return
+
+    if "{name}" in output_filename:
+        check_output_names(input_filenames, output_filename)
+    elif len(input_filenames) > 1 and not rdkit_utils.is_sdf(output_filename):
+        # the fields are written as columns, so they must be the same for all the inputs. SDF outputs write the
+        # fields by name so can mix them
+        check_same_fields(
+            input_filenames,
+            delimiter=delimiter,
+            read_header=read_header,
+            id_column=id_column,
+            sdf_read_records=sdf_read_records,
+        )
+
+    # the models are loaded once for all the inputs
+    t0 = time.time()
+    models = load_models(model_ids, model_base_path, mmap_models=mmap_models, model_cache_dir=model_cache_dir)
+    load_time = time.time() - t0
+
+    cascade = Cascade(models, filters, mode=cascade_mode) if filters else None
+    if filters or score:
+        # check the filters and the expression before running anything
+        columns = output_names(models)
+    if cascade:
+        cascade.check_names(columns)
+    if score:
+        if "{name}" not in output_filename and len(input_filenames) > 1:
+            columns.append(source_prop_name)
+        Ranker(score, top_k=top_k, threshold=threshold).check_names(columns)
+    elif top_k or threshold is not None:
+        raise ValueError('A score expression is needed for top_k and threshold')
+
+    if estimate_only:
+        estimate(
+            models, input_filenames, output_filename, load_time,
+            sample_size=estimate_sample_size,
+            delimiter=delimiter,
+            legacy_charges=legacy_charges,
+            read_header=read_header,
+            write_header=write_header,
+            id_column=id_column,
+            sdf_read_records=sdf_read_records,
+            reporting_interval=reporting_interval,
+            batch_size=batch_size,
+            cascade=cascade,
+            top_k=top_k,
+        )
+        return
+
+    DmLog.emit_event("Starting predictions")
+
+    # the bad records are summarised rather than reported one by one
+    rejects = rdkit_utils.RejectsWriter(rejects_filename)
+    t0 = time.time()
+
+    num_outputs = 0
+    count = 0
+    evaluations = 0
+    per_input = "{name}" in output_filename
+    if per_input:
+        # one output per input. Process the largest files first
+        input_filenames.sort(key=os.path.getsize, reverse=True)
+        outputs = [output_filename.format(name=input_name(filename)) for filename in input_filenames]
+    else:
+        outputs = [output_filename] * len(input_filenames)
+    # the options that are the same for all the inputs
+    options = dict(
+        delimiter=delimiter,
+        read_header=read_header,
+        id_column=id_column,
+        sdf_read_records=sdf_read_records,
+        reporting_interval=reporting_interval,
+        batch_size=batch_size,
+        cascade=cascade,
+        rejects=rejects,
+        validate_smiles=validate_smiles,
+    )
+    writer = None
+    header_written = False
+    for i, (filename, output) in enumerate(zip(input_filenames, outputs)):
+        if writer is None:
+            writer = rdkit_utils.create_writer(
+                output,
+                delimiter=delimiter,
+                legacy_charges=legacy_charges,
+            )
+            logging.info('writer created: %s', output)
+            ranker = Ranker(score, top_k=top_k, threshold=threshold) if score else None
+        file_outputs, molecules, file_evaluations, file_header_written = predict_file(
+            models, filename, writer, rdkit_utils.is_sdf(output),
+            # the header is only written once to a concatenated output, by the first file that writes records
+            write_header=write_header and (per_input or not header_written),
+            source=filename if not per_input and len(input_filenames) > 1 else None,
+            # SDF outputs of a previous run already hold the fragments
+            fragment=not (append and rdkit_utils.is_sdf(filename)),
+            ranker=ranker,
+            **options,
+        )
+        num_outputs += file_outputs
+        count += molecules
+        evaluations += file_evaluations
+        header_written = header_written or file_header_written
+        if per_input or i == len(input_filenames) - 1:
+            if ranker:
+                num_outputs += ranker.write(writer)
+            writer.close()
+            writer = None
+
+    rejects.close()
+    elapsed = time.time() - t0
+
+    DmLog.emit_event(num_outputs, "outputs among", count, "molecules")
+    if elapsed > 0:
+        DmLog.emit_event(f"{count / elapsed:.1f} molecules per second")
+    if cascade:
+        DmLog.emit_event(evaluations, "model evaluations")
+        DmLog.emit_cost(evaluations)
+    else:
+        DmLog.emit_cost(count * len(models.keys()))
+
+
+def existing_model_ids(input_filenames, model_ids, delimiter=None, id_column=None, sdf_read_records=100):
+    """
+    Find the models whose predictions are already present in all the inputs (previous outputs), based on the
+    <Model>_Prediction field names generated by get_calc_prop_names.
+    :return: Set of model IDs
+    """
+    present = set(model_ids)
+    for filename in input_filenames:
+        reader = rdkit_utils.create_reader(
+            filename,
+            delimiter=delimiter,
+            read_header=True,
+            id_column=id_column,
+            sdf_read_records=sdf_read_records,
+        )
+        field_names = reader.get_extra_field_names() or []
+        reader.close()
+        present = {model_id for model_id in present
+                   if format_name(models_meta[model_id]) + "_Prediction" in field_names}
+    return present
+
+
+def input_field_names(filename, delimiter=None, read_header=True, id_column=None, sdf_read_records=100):
+    """
+    Get the names of the fields that are passed through from an input, in the order of the record properties.
+    Without a header line the SMILES fields are named field2, field3 ... from the first readable record.
+    :return: List of names
+    """
+    reader = rdkit_utils.create_reader(
+        filename,
+        delimiter=delimiter,
+        read_header=read_header,
+        id_column=id_column,
+        sdf_read_records=sdf_read_records,
+        mol_props=False,
+    )
+    try:
+        if isinstance(reader, rdkit_utils.SdfReader):
+            return list(reader.field_names)
+        if reader.field_names:
+            return reader.field_names[1:]
+        while True:
+            try:
+                record = reader.read()
+            except TypeError:
+                continue
+            except StopIteration:
+                return []
+            return ['field' + str(i + 2) for i in range(len(record.props))]
+    finally:
+        reader.close()
+
+
+def check_same_fields(input_filenames, **kwargs):
+    """
+    Check that all the inputs have the same fields, as they are written as columns of the same output.
+    :param kwargs: Arguments for input_field_names
+    :raises ValueError: If the fields differ
+    """
+    first = input_filenames[0]
+    first_names = input_field_names(first, **kwargs)
+    for filename in input_filenames[1:]:
+        names = input_field_names(filename, **kwargs)
+        if names != first_names:
+            raise ValueError(
+                f"Inputs {first} and {filename} have different fields ({', '.join(first_names)} and "
+                f"{', '.join(names)}) so cannot be written to the same output. "
+                "Use {name} in the output file name to write one output per input"
+            )
+
+
+def check_output_names(input_filenames, output_filename):
+    """
+    Check that each input has its own output, as inputs with the same name in different directories would write to
+    the same file.
+    :param output_filename: The output file name, containing {name}
+    :raises ValueError: If two inputs have the same output
+    """
+    outputs = {}
+    for filename in input_filenames:
+        output = output_filename.format(name=input_name(filename))
+        if output in outputs:
+            raise ValueError(f"Inputs {outputs[output]} and {filename} would both be written to {output}")
+        outputs[output] = filename
+
+
+def expand_inputs(inputs):
+    """
+    Expand the inputs into a list of files.
+    :param inputs: A file name or a list of file names, glob patterns or directories
+    :return: List of file names
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    filenames = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            matches = [str(path) for path in sorted(Path(inp).iterdir())
+                       if path.is_file() and path.name.endswith(input_extensions)]
+            if not matches:
+                DmLog.emit_event(f"No input files in {inp}")
+            filenames.extend(matches)
+        elif glob.has_magic(inp):
+            matches = sorted(glob.glob(inp))
+            if not matches:
+                DmLog.emit_event(f"No files match {inp}")
+            filenames.extend(matches)
+        else:
+            filenames.append(inp)
+    # drop duplicates, keeping the order
+    return list(dict.fromkeys(filenames))
+
+
+def input_name(filename):
+    """The file name without the directory and the extensions (.smi.gz -> '')"""
+    name = os.path.basename(filename)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return os.path.splitext(name)[0]
+
+
+def load_models(model_ids, model_base_path, mmap_models=False, model_cache_dir=None):
+    """
+    Load the models.
+    :param model_ids: The IDs of the models
+    :param model_base_path: The URL or directory from which the models are loaded
+    :param mmap_models: Load the models from the memory mappable format (see load_model)
+    :param model_cache_dir: The directory for the memory mappable files. Defaults to the MODEL_CACHE_DIR environment
+                            variable. Needed with mmap_models for models loaded from a URL
+    :return: Dict of the loaded models, keyed by model ID
+    """
+    # if not given, try to extract from env variable, otherwise use the public models
     if not model_base_path:
         logging.info('trying base path from env')
-        try:
-            model_base_path = os.environ['BASE_MODEL_URL']
-        except KeyError:
-            logging.warning('Base model url not set!')
-            DmLog.emit_event(f"Base model url not set!")
-            # assume testing regime and use the default directory
-            model_base_path = "/models"
+        model_base_path = os.environ.get('BASE_MODEL_URL', default_model_base_path)
+    if not model_cache_dir:
+        model_cache_dir = os.environ.get('MODEL_CACHE_DIR')
 
     logging.info('model_base_path: %s', model_base_path)
+    url = urlparse(model_base_path)
+    if url.scheme == 'file':
+        model_base_path = url.path
+    elif url.netloc and not model_base_path.endswith('/'):
+        # otherwise urljoin replaces the last part of the path
+        model_base_path += '/'
+    if mmap_models and url.netloc and not model_cache_dir:
+        # the downloaded models are temporary files, a copy written next to them would never be used again
+        logging.warning('the models are not memory mapped as they are loaded from a URL and no cache directory is set')
+        mmap_models = False
+    if mmap_models and model_cache_dir:
+        os.makedirs(model_cache_dir, exist_ok=True)
     # TODO: when there's more models, reading them in advance may put
     # too much pressure on memory. it's not too bad now, but may need
     # to be evaluated later
     models = {}
-    for model_id in set(model_ids):
+    # keep the order of the models so that the output columns are always in the same order
+    for model_id in dict.fromkeys(model_ids):
         logging.info('resolving model: %s', model_id)
-        if urlparse(model_base_path).netloc:
+        mmap_file = None
+        if mmap_models:
+            if model_cache_dir:
+                mmap_file = Path(model_cache_dir).joinpath(f"{model_id}.jmodel.joblib")
+            else:
+                mmap_file = Path(model_base_path).joinpath(f"{model_id}.jmodel.joblib")
+        if url.netloc:
+            if mmap_file and mmap_file.exists():
+                # the model ID identifies the model, so the cached copy is used without fetching it again. Remove it
+                # to pick up a new version of the model
+                logging.info('using cached model %s', mmap_file)
+                models[model_id] = joblib.load(mmap_file, mmap_mode='r')
+                DmLog.emit_event(f"{models_meta[model_id]} loaded")
+                continue
             logging.info('web address')
             try:
                 logging.info('fetching model %s', urljoin(model_base_path, f"{model_id}.jmodel"))
                 model_file = urlretrieve(urljoin(model_base_path, f"{model_id}.jmodel"))[0]
-            except HTTPError:
+            except URLError:
                 logging.info('model %s not available at url', model_id)
                 DmLog.emit_event(f"Model {model_id} not available!")
                 continue
@@ -103,7 +478,7 @@ def run(
 
         try:
             logging.info('loading model file: %s', model_file)
-            models[model_id] = MolecularModel().load(model_file)
+            models[model_id] = load_model(model_file, mmap_file=mmap_file)
             DmLog.emit_event(f"{models_meta[model_id]} loaded")
         except FileNotFoundError:
             logging.info('model not found')
@@ -111,18 +486,109 @@ def run(
             continue
 
     logging.info('models resolved')
-    with open(input_filename, 'r') as inp_test:
+    return models
+
+
+def load_model(model_file, mmap_file=None):
+    """
+    Load a model file.
+    With mmap_file the model is converted once to that joblib file, in which the numpy arrays are stored uncompressed
+    and page aligned. That file is then loaded with mmap so that the arrays are shared between the processes (and
+    jobs) on a node rather than each process having its own copy.
+    Only the arrays that the model keeps as plain numpy arrays are shared. scikit-learn trees copy their node and
+    value arrays into memory of their own when they are unpickled, so tree based models (e.g. random forests) still
+    have a copy in each process.
+    :param model_file: The .jmodel file
+    :param mmap_file: The memory mappable file to use, or None to load the .jmodel file
+    :return: The model
+    """
+    if not mmap_file:
+        return MolecularModel().load(model_file)
+
+    model_file = str(model_file)
+    mmap_file = str(mmap_file)
+    if not os.path.exists(mmap_file) or os.path.getmtime(mmap_file) < os.path.getmtime(model_file):
+        model = MolecularModel().load(model_file)
+        try:
+            convert_model(model, mmap_file)
+        except OSError as ex:
+            logging.warning('could not write %s: %s', mmap_file, ex)
+            return model
+    logging.info('memory mapping model file: %s', mmap_file)
+    return joblib.load(mmap_file, mmap_mode='r')
+
+
+def convert_model(model, mmap_file):
+    """
+    Write the model in a format where the numpy arrays can be memory mapped.
+    The file is written to a temporary name and then moved so that concurrent jobs never see a partial file.
+    :param model: The loaded model
+    :param mmap_file: The file to write
+    """
+    logging.info('writing memory mappable model file: %s', mmap_file)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(mmap_file) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        joblib.dump(model, tmp)
+        os.replace(tmp, mmap_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def predict_file(
+    models: dict,
+    input_filename: str,
+    writer,
+    mol_props: bool,
+    delimiter=None,
+    read_header: bool = True,
+    write_header: bool = True,
+    id_column=None,
+    sdf_read_records: int = 100,
+    reporting_interval: int = 100,
+    batch_size: int = 1000,
+    source: str = None,
+    cascade=None,
+    fragment: bool = True,
+    ranker=None,
+    rejects=None,
+    validate_smiles: bool = False,
+):
+    """
+    Run the models over one input file, writing the results with the writer.
+    :param mol_props: Whether the reader needs to set the extra fields as molecule properties (SDF output)
+    :param source: If specified an extra source_file column with this value is written
+    :param cascade: Optional Cascade that runs the models and filters the molecules
+    :param fragment: Whether to use the biggest fragment of the molecules
+    :param ranker: Optional Ranker that scores the molecules. In top-k mode the records are kept by the ranker
+                   and must be written with Ranker.write()
+    :param rejects: Optional RejectsWriter for the records that cannot be read. If not specified an event is
+                    emitted for each of them
+    :param validate_smiles: Reject SMILES with invalid characters before parsing them
+    :return: Tuple of the number of outputs, the number of molecules read, the number of model evaluations and
+             whether the header was written
+    """
+    with (gzip.open if input_filename.endswith('.gz') else open)(input_filename, 'rt') as inp_test:
         for i, line in enumerate(inp_test):
             logging.info('line %s: %s', i, line)
             if i > 9:
                 break
     
+    # the SDF writer uses the molecules, the other writers the SMILES and the property values
+    sdf_output = isinstance(writer, rdkit_utils.SdfWriter)
+    pass_through = rdkit_utils.can_pass_through(input_filename, writer, delimiter, id_column=id_column)
+
     reader = rdkit_utils.create_reader(
         input_filename,
         delimiter=delimiter,
         read_header=read_header,
         id_column=id_column,
         sdf_read_records=sdf_read_records,
+        # molecule properties are only written by the SDF writer
+        mol_props=mol_props,
+        keep_raw=pass_through,
+        validate=validate_smiles,
     )
 
     logging.info('reader created')
@@ -131,80 +597,470 @@ def run(
 
     logging.info('extra field names: %s', extra_field_names)
     
-    writer = rdkit_utils.create_writer(
-        output_filename,
-        delimiter=delimiter,
-    )
-    
-    logging.info('writer created')
-    DmLog.emit_event("Starting predictions")
-    
     num_outputs = 0
+    evaluations = 0
+    header_written = False
+    records = []
     count = -1
     while True:
         count += 1
         logging.info('loop starts: %s', count)
         try:
-            mol, smi, mol_id, props = reader.read()
-            logging.info('mol: %s', mol)
-            logging.info('smi: %s', smi)
-            logging.info('mol_id: %s', mol_id)
-            logging.info('props: %s', props)
+            record = reader.read()
+            logging.debug('record: %s', record)
         except TypeError as ex:
-            DmLog.emit_event(f"{ex}")
+            if rejects:
+                rejects.add(ex, source=input_filename)
+            else:
+                DmLog.emit_event(f"{ex}")
             continue
         except StopIteration as ex:
             # end of file
             break
 
         # get the biggest fragment, eliminate salts, etc
-        mol = rdkit_utils.fragment(mol, 'hac')
+        mol = record.mol
+        if fragment:
+            mol = rdkit_utils.fragment(mol, 'hac')
 
-        num_outputs += 1
         if (count + 1) % reporting_interval == 0:
             DmLog.emit_event(f'{count + 1} molecules processed')
 
-        values = []
-        calc_prop_names = []
-                    
-        for model_id, model in models.items():
-            # actual prediction
-            logging.info('predicting with: %s', model_id)
-            model(mol)
-            values.extend(get_calc_values(model))
-            calc_prop_names.extend(get_calc_prop_names(model, format_name(models_meta[model_id])))
+        if cascade:
+            evaluations -= cascade.evaluations
+            values, calc_prop_names, passed = cascade.predict(mol)
+            evaluations += cascade.evaluations
+            if values is None:
+                # rejected by the filters
+                continue
+        else:
+            values = []
+            calc_prop_names = []
+
+            for model_id, model in models.items():
+                # actual prediction
+                logging.info('predicting with: %s', model_id)
+                model(mol)
+                values.extend(get_calc_values(model))
+                calc_prop_names.extend(get_calc_prop_names(model, format_name(models_meta[model_id])))
+
+                # impractical to have them here
+                # model_type = "classification" if model.probability else "regression"
+                # DmLog.emit_event(f'Running "{models_meta[model_id]}" ({model_type})')
+            evaluations += len(models)
 
-            # impractical to have them here
-            # model_type = "classification" if model.probability else "regression"
-            # DmLog.emit_event(f'Running "{models_meta[model_id]}" ({model_type})')
+        if source is not None:
+            values.append(source)
+            calc_prop_names.append(source_prop_name)
 
+        if ranker:
+            values.append(ranker.score(calc_prop_names, values))
+            calc_prop_names.append(score_prop_name)
 
-        if count == 1 and write_header:
+        if write_header and not header_written and not sdf_output:
             logging.info('writing header')
-            headers = rdkit_utils.generate_header_values(extra_field_names, len(props), calc_prop_names)
+            headers = rdkit_utils.generate_header_values(extra_field_names, len(record.props), calc_prop_names)
             logging.info('headers: %s', headers)
 
             writer.write_header(headers)
+            header_written = True
 
-            
-        logging.info('writing the rest')
-        
-        writer.write(
-            smiles=smi,
-            mol=mol,
-            mol_id=mol_id,
-            existing_props=props,  # only used in SmilesWriter
-            prop_names=calc_prop_names,  # only used in SdfWriter
-            new_props=values,
-        )
+        # the raw text can only be written back if the molecule was not changed by the fragmentation
+        raw = record.raw if pass_through and (mol is record.mol or not sdf_output) else None
+        # existing_props are only used in SmilesWriter, prop_names only in SdfWriter
+        if sdf_output:
+            t = (None, mol, record.id, None, values, raw)
+        else:
+            t = (record.smiles, None, record.id, record.props, values, raw)
+            record.release_mol()
 
-        logging.info('mol written, num_outputs: %s', num_outputs)
+        if ranker and not ranker.accept(values[-1], t, calc_prop_names):
+            continue
+
+        num_outputs += 1
+        records.append(t)
+        if len(records) >= batch_size:
+            logging.info('writing %s records', len(records))
+            writer.write_batch(records, prop_names=calc_prop_names)
+            records = []
+
+    if records:
+        writer.write_batch(records, prop_names=calc_prop_names)
 
     reader.close()
-    writer.close()
-    
-    DmLog.emit_event(num_outputs, "outputs among", count, "molecules")
-    DmLog.emit_cost(count * len(models.keys()))
+
+    return num_outputs, count, evaluations, header_written
+
+
+def estimate(models, input_filenames, output_filename, load_time, sample_size=200, delimiter=None,
+             legacy_charges=False, read_header=True, top_k=None, **kwargs):
+    """
+    Estimate the wall time, peak memory, output size and cost of a run without running all the predictions.
+    The records are counted and a sample spread evenly through each file (in proportion to its size) is run
+    through the full pipeline.
+    :param load_time: The time it took to load the models, in seconds
+    :param sample_size: The total number of records to sample
+    :param top_k: The number of records kept for ranking, which are held in memory
+    :param kwargs: Additional arguments for predict_file
+    :return: Dict with the estimates
+    """
+    counts = [count_records(filename, read_header=read_header) for filename in input_filenames]
+    total = sum(counts)
+    DmLog.emit_event(f"{total} records in {len(input_filenames)} file(s)")
+
+    sampled = 0
+    evaluations = 0
+    elapsed = 0.0
+    output_bytes = 0
+    chunk_size = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, 'sample' + file_suffix(output_filename))
+        for i, (filename, count) in enumerate(zip(input_filenames, counts)):
+            if not count:
+                continue
+            num = max(1, round(sample_size * count / total))
+            sample = os.path.join(tmpdir, f'sample{i}' + file_suffix(filename).replace('.gz', ''))
+            write_sample(filename, sample, count, num, read_header=read_header)
+            writer = rdkit_utils.create_writer(output, delimiter=delimiter, legacy_charges=legacy_charges)
+            t0 = time.time()
+            _, molecules, sample_evaluations, _ = predict_file(models, sample, writer, rdkit_utils.is_sdf(output),
+                                                            delimiter=delimiter, read_header=read_header, **kwargs)
+            writer.close()
+            # the columnar writers buffer their rows
+            chunk_size = getattr(writer, 'chunk_size', 0)
+            elapsed += time.time() - t0
+            sampled += molecules
+            evaluations += sample_evaluations
+            output_bytes += os.path.getsize(output)
+
+    if not sampled:
+        DmLog.emit_event("No records to estimate from!")
+        return None
+
+    per_record = elapsed / sampled
+    # kilobytes on linux
+    sample_peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # the full run also holds the batch being written, the rows buffered by the columnar writers and the top-k
+    # records, of which the sample only held as many as it had records. Their memory is estimated from the output
+    # size of a record so is a lower bound
+    held = min(total, kwargs.get('batch_size', 1000) + chunk_size + (top_k or 0))
+    record_mb = output_bytes / sampled / 1024 / 1024
+    results = {
+        'records': total,
+        'wall_time': load_time + per_record * total,
+        'sample_peak_memory_mb': sample_peak_mb,
+        'peak_memory_mb': sample_peak_mb + max(0, held - sampled) * record_mb,
+        'output_mb': record_mb * total,
+        'cost': total * len(models.keys()) if kwargs.get('cascade') is None else round(evaluations / sampled * total),
+    }
+    DmLog.emit_event(
+        f"Estimate from {sampled} records: {results['records']} records,"
+        f" {results['wall_time']:.0f} s ({per_record * 1000:.1f} ms/record, {load_time:.1f} s loading models),"
+        f" peak memory {results['peak_memory_mb']:.0f} MB ({sample_peak_mb:.0f} MB measured for the sample,"
+        f" up to {held} records buffered), output {results['output_mb']:.1f} MB,"
+        f" cost {results['cost']}"
+    )
+    return results
+
+
+def file_suffix(filename):
+    """The extension of the file name, including .gz if compressed (e.g. .sdf.gz)"""
+    if filename.endswith('.gz'):
+        return os.path.splitext(filename[:-3])[1] + '.gz'
+    return os.path.splitext(filename)[1]
+
+
+def open_binary(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def count_records(filename, read_header=True, chunk_size=1024 * 1024):
+    """
+    Quickly count the records in a file by scanning for newlines (SMILES) or $$$$ lines (SDF).
+    :param read_header: For SMILES, whether the first line is a header
+    :return: The number of records
+    """
+    sdf = rdkit_utils.is_sdf(filename)
+    token = b'$$$$' if sdf else b'\n'
+    count = 0
+    last = b''
+    tail = b''
+    with open_binary(filename) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            # keep the end of the previous chunk so that a token is not split
+            buf = tail + chunk
+            count += buf.count(token)
+            tail = buf[1 - len(token):] if len(token) > 1 else b''
+            last = chunk
+    if not sdf:
+        # last line without a newline
+        if last and not last.endswith(b'\n'):
+            count += 1
+        if read_header and count:
+            count -= 1
+    return count
+
+
+def write_sample(filename, sample_filename, count, num, read_header=True):
+    """
+    Write a sample of num records, spread evenly through the file, to an uncompressed file.
+    :param count: The number of records in the file
+    """
+    step = max(count / num, 1.0)
+    indices = set(int(i * step) for i in range(num))
+    with open_binary(filename) as f, open(sample_filename, 'wb') as out:
+        if rdkit_utils.is_sdf(filename):
+            records = (r.encode('utf-8') for r in rdkit_utils.sdf_record_gen(f))
+        else:
+            if read_header:
+                out.write(f.readline())
+            records = f
+        for i, record in enumerate(records):
+            if i in indices:
+                out.write(record)
+                indices.discard(i)
+                if not indices:
+                    break
+
+
+class Cascade:
+    """
+    Runs the models on a molecule, evaluating the filters after each model so that the remaining models are not run
+    for molecules that fail them.
+    Each filter is of the form "<column> <op> <value>", where the column is an output column such as
+    hERG_model_Prediction (the model ID can also be used as the prefix, e.g. herg_Prediction), the op is one of
+    < <= > >= == != and the value is a number or True/False.
+    The models with filters are run first, cheapest first, based on their measured time per molecule.
+    """
+
+    modes = ('drop', 'empty')
+
+    def __init__(self, models, filters, mode='drop'):
+        """
+        :param models: Dict of the models, keyed by model ID
+        :param filters: List of filter expressions
+        :param mode: drop the molecules that fail the filters, or write them with empty values
+        """
+        if mode not in self.modes:
+            raise ValueError('Invalid cascade mode:', mode)
+        self.models = models
+        self.mode = mode
+        # model ID -> list of (column, op, value)
+        self.predicates = {}
+        for text in filters:
+            model_id, predicate = self.parse_filter(text)
+            self.predicates.setdefault(model_id, []).append(predicate)
+        # model ID -> [total time, number of molecules]
+        self.times = {model_id: [0.0, 0] for model_id in self.predicates}
+        # model ID -> output column names
+        self.names = {}
+        self.evaluations = 0
+
+    def parse_filter(self, text):
+        match = filter_pattern.match(text)
+        if not match:
+            raise ValueError('Invalid filter:', text)
+        column, op, value = match.groups()
+        if value.lower() in ('true', 'false'):
+            value = value.lower() == 'true'
+        else:
+            value = float(value)
+
+        # match the longest prefix first as some model names start with others
+        prefixes = []
+        for model_id in self.models:
+            prefixes.append((format_name(models_meta[model_id]), model_id))
+            prefixes.append((model_id, model_id))
+        for prefix, model_id in sorted(prefixes, key=lambda p: len(p[0]), reverse=True):
+            if column.startswith(prefix + '_'):
+                column = format_name(models_meta[model_id]) + column[len(prefix):]
+                return model_id, (column, filter_ops[op], value)
+        raise ValueError('Filter does not match any of the models:', text)
+
+    def check_names(self, columns):
+        """
+        Check that the columns used by the filters are output columns.
+        :raises ValueError: If any are not
+        """
+        unknown = [column for predicates in self.predicates.values() for column, op, value in predicates
+                   if column not in columns]
+        if unknown:
+            raise ValueError(f'Invalid filter: unknown columns {", ".join(unknown)}. '
+                             f'The columns are {", ".join(columns)}')
+
+    def run_model(self, model_id, mol):
+        model = self.models[model_id]
+        t0 = time.perf_counter()
+        model(mol)
+        if model_id in self.times:
+            t = self.times[model_id]
+            t[0] += time.perf_counter() - t0
+            t[1] += 1
+        self.evaluations += 1
+        if model_id not in self.names:
+            self.names[model_id] = get_calc_prop_names(model, format_name(models_meta[model_id]))
+        return get_calc_values(model)
+
+    def gate_order(self):
+        # models that have not been timed yet come first so that they get measured
+        return sorted(self.predicates, key=lambda m: self.times[m][0] / self.times[m][1] if self.times[m][1] else 0.0)
+
+    def predict(self, mol):
+        """
+        Run the models on the molecule.
+        :return: Tuple of the values, the names of the values and whether the molecule passed the filters.
+                 The values and names are None if the molecule failed and the mode is drop.
+        """
+        results = {}
+        passed = True
+        for model_id in self.gate_order():
+            values = self.run_model(model_id, mol)
+            results[model_id] = values
+            row = dict(zip(self.names[model_id], values))
+            for column, op, value in self.predicates[model_id]:
+                if column not in row:
+                    raise ValueError(f'Model {model_id} does not generate {column}')
+                if not op(row[column], value):
+                    passed = False
+                    break
+            if not passed:
+                break
+
+        if not passed and self.mode == 'drop':
+            return None, None, False
+
+        values = []
+        names = []
+        for model_id in self.models:
+            if model_id not in results:
+                if passed:
+                    results[model_id] = self.run_model(model_id, mol)
+                elif model_id not in self.names:
+                    # the model has not been run yet so its columns are not known
+                    self.run_model(model_id, mol)
+            names.extend(self.names[model_id])
+            values.extend(results.get(model_id) or [None] * len(self.names[model_id]))
+        return values, names, passed
+
+
+class Ranker:
+    """
+    Scores the molecules with an expression over the output columns, e.g.
+    "gmean(hERG_model_Inactive, AMES_model_Inactive) * (Aqueous_solubility_model_Prediction > -4)".
+    The functions in score_functions can be used.
+    In top-k mode only the k best records are kept, in a heap, and written at the end. In threshold mode the records
+    scoring at least the threshold are accepted as they are generated.
+    """
+
+    def __init__(self, expression, top_k=None, threshold=None):
+        if top_k is None and threshold is None:
+            raise ValueError('Either top_k or threshold is needed')
+        self.expression = expression
+        tree = self.parse(expression)
+        self.names = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)} - set(score_functions))
+        self.code = compile(tree, '<score>', 'eval')
+        self.top_k = top_k
+        self.threshold = threshold
+        self.heap = []
+        self.seq = 0
+        self.prop_names = None
+
+    @staticmethod
+    def parse(expression):
+        """
+        Parse the expression, only allowing names, constants, arithmetic, comparisons, and/or and calls of the
+        score_functions, so that it is safe to evaluate.
+        :return: The syntax tree
+        :raises ValueError: If the expression is invalid or uses anything else
+        """
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as ex:
+            raise ValueError(f'Invalid score expression {expression}: {ex.msg}')
+        for node in ast.walk(tree):
+            if not isinstance(node, score_nodes):
+                raise ValueError(f'Invalid score expression {expression}: {type(node).__name__} is not allowed')
+            if isinstance(node, ast.Call) and (
+                    not isinstance(node.func, ast.Name) or node.func.id not in score_functions or node.keywords):
+                raise ValueError(f'Invalid score expression {expression}: only the functions '
+                                 f'{", ".join(score_functions)} can be called')
+        return tree
+
+    def check_names(self, columns):
+        """
+        Check that the names used by the expression are output columns.
+        :raises ValueError: If any are not
+        """
+        unknown = [name for name in self.names if name not in columns]
+        if unknown:
+            raise ValueError(f'Invalid score expression {self.expression}: unknown columns {", ".join(unknown)}. '
+                             f'The columns are {", ".join(columns)}')
+
+    def score(self, names, values):
+        """
+        Evaluate the expression.
+        :return: The score, or None if it cannot be calculated (e.g. missing values)
+        """
+        namespace = dict(score_functions)
+        namespace.update(zip(names, values))
+        try:
+            return float(eval(self.code, {'__builtins__': {}}, namespace))
+        except NameError as ex:
+            raise ValueError(f'Invalid score expression {self.expression}: {ex}')
+        except (TypeError, ValueError, ArithmeticError):
+            return None
+
+    def accept(self, score, record, prop_names):
+        """
+        Offer a record.
+        :return: True if the record should be written now
+        """
+        if score is None:
+            return False
+        if self.top_k is None:
+            return score >= self.threshold
+        if self.threshold is not None and score < self.threshold:
+            return False
+        self.prop_names = prop_names
+        # the sequence number keeps the order stable and avoids comparing the records
+        item = (score, -self.seq, record)
+        self.seq += 1
+        if len(self.heap) < self.top_k:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+        return False
+
+    def write(self, writer):
+        """
+        Write the top-k records, best first.
+        :return: The number of records written
+        """
+        records = [item[2] for item in sorted(self.heap, reverse=True)]
+        if records:
+            writer.write_batch(records, prop_names=self.prop_names)
+        self.heap = []
+        return len(records)
+
+
+def output_names(models):
+    """
+    Get the names of the output columns of the models.
+    These depend on the type of the model, so the models are run on a probe molecule.
+    :param models: Dict of the models, keyed by model ID
+    :return: List of names
+    """
+    mol = Chem.MolFromSmiles(probe_smiles)
+    names = []
+    for model_id, model in models.items():
+        model(mol)
+        names.extend(get_calc_prop_names(model, format_name(models_meta[model_id])))
+    return names
 
 
 def get_calc_prop_names(molmod, prefix):
@@ -263,8 +1119,17 @@ def format_name(name):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Predict properties with a Jaqpot model")
     parser.add_argument("models", metavar="Model ID", nargs="+", help="List of Jaqpot model IDs")
-    parser.add_argument("-i", "--input", required=True, help="Input")
-    parser.add_argument("-o", "--output", default="result.sdf", help="The output file")
+    parser.add_argument(
+        "-i", "--input",
+        required=True,
+        nargs="+",
+        help="Input files, glob patterns or directories",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default="result.sdf",
+        help="The output file. Use {name} in the file name to write one output per input",
+    )
     parser.add_argument("-d", "--delimiter", default="\t", help="Delimiter when using SMILES")
     parser.add_argument(
         "--id-column",
@@ -296,8 +1161,87 @@ if __name__ == "__main__":
         "--model-base-path",
         default="",
         type=str,
-        help="Model location, URL or path",
+        help="Model location, URL (http(s):// or file://) or directory. Defaults to the BASE_MODEL_URL "
+             "environment variable, or the public models",
     )     
+    parser.add_argument(
+        "--legacy-charges",
+        action="store_true",
+        help="Also write the deprecated atom block charge codes when writing SDF (e.g. for rDock)",
+    )
+    parser.add_argument(
+        "--mmap-models",
+        action="store_true",
+        help="Load the models from a memory mappable copy (created if missing) so that processes on a node "
+             "share the plain numpy arrays of the models. The arrays of scikit-learn trees are still copied. "
+             "The copy is written next to the .jmodel file, or to --model-cache-dir which is needed for models "
+             "loaded from a URL",
+    )
+    parser.add_argument(
+        "--model-cache-dir",
+        help="Directory for the memory mappable copies of the models, keyed by model ID. Defaults to the "
+             "MODEL_CACHE_DIR environment variable",
+    )
+    parser.add_argument(
+        "--filter",
+        action="append",
+        help="Only keep molecules passing this filter, e.g. 'hERG_model_Prediction == 0'. Can be repeated. "
+             "The filtered models are run first and the other models are not run for molecules that fail",
+    )
+    parser.add_argument(
+        "--cascade",
+        default="drop",
+        choices=Cascade.modes,
+        help="Drop the molecules that fail a filter or write them with empty values",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="The input is the output of a previous run. Only the models whose predictions are missing are run "
+             "and their columns are added to the existing ones",
+    )
+    parser.add_argument(
+        "--score",
+        help="Expression over the output columns used to rank the molecules with --top-k or --threshold, "
+             "e.g. 'gmean(hERG_model_Inactive, AMES_model_Inactive)'. Only arithmetic, comparisons, and/or and "
+             "the functions " + ", ".join(score_functions) + " can be used",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        help="Only write the K molecules with the highest score",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Only write the molecules with a score of at least this value",
+    )
+    parser.add_argument(
+        "--rejects",
+        help="Write the records that cannot be read to this tab separated file",
+    )
+    parser.add_argument(
+        "--validate-smiles",
+        action="store_true",
+        help="Reject SMILES containing invalid characters before parsing them",
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="Only estimate the run time, peak memory, output size and cost from a sample of the records",
+    )
+    parser.add_argument(
+        "--estimate-sample-size",
+        default=200,
+        type=int,
+        help="The number of records to sample for --estimate",
+    )
+    parser.add_argument(
+        "--batch-size",
+        default=1000,
+        type=int,
+        help="Write the outputs in batches of N records",
+    )
 
     args = parser.parse_args()
 
@@ -311,4 +1255,18 @@ if __name__ == "__main__":
         sdf_read_records=args.sdf_read_records,
         reporting_interval=args.reporting_interval,
         model_base_path=args.model_base_path,
+        legacy_charges=args.legacy_charges,
+        batch_size=args.batch_size,
+        estimate_only=args.estimate,
+        estimate_sample_size=args.estimate_sample_size,
+        mmap_models=args.mmap_models,
+        model_cache_dir=args.model_cache_dir,
+        filters=args.filter,
+        cascade_mode=args.cascade,
+        append=args.append,
+        score=args.score,
+        top_k=args.top_k,
+        threshold=args.threshold,
+        rejects_filename=args.rejects,
+        validate_smiles=args.validate_smiles,
     )
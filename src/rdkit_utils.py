@@ -14,51 +14,143 @@
 
 from argparse import ArgumentError
 import gzip
-from rdkit import Chem
+import logging
+import multiprocessing
+import re
+import time
+from collections import Counter
+import numpy as np
+import pandas as pd
+from rdkit import Chem, DataStructs
+from dm_job_utilities.dm_log import DmLog
 import utils
 
-class SdfWriter:
+# pyarrow is optional, it is only needed for the Parquet and Arrow outputs
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
 
-    def __init__(self, outfile):
-        if outfile.endswith('.gz'):
-            self.gzip = gzip.open(outfile, 'wt')
-            self.writer = Chem.SDWriter(self.gzip)
-        else:
-            self.gzip = None
-            self.writer = Chem.SDWriter(outfile)
+hydrogen_mass = Chem.GetPeriodicTable().GetAtomicWeight(1)
 
-    def write(self, smiles=None, mol=None, mol_id=None, existing_props=None, prop_names=None, new_props=None, smiles_prop_name=None):
+# the characters that can be in a SMILES, used for a quick check before parsing
+smiles_pattern = re.compile(r'^[A-Za-z0-9@+\-\[\]()=#$%/\\.:*~&!,;^]+$')
+
+# size of the output buffers used by the writers
+default_buffer_size = 1024 * 1024
+
+# the header line of an SD data item, e.g. ">  <name>  (1)"
+data_header_pattern = re.compile(r'^>.*?<([^>]*)>')
+
+
+def open_output(outfile, buffer_size=default_buffer_size):
+    """Open a text file for writing, gzipped if the name ends with .gz"""
+    if outfile.endswith('.gz'):
+        return gzip.open(outfile, 'wt')
+    else:
+        return open(outfile, 'w', buffering=buffer_size)
+
+
+class SdfWriter:
+
+    def __init__(self, outfile, legacy_charges=False, buffer_size=default_buffer_size):
+        """
+        :param outfile: The output file (.sdf or .sdf.gz)
+        :param legacy_charges: Also write the deprecated atom block charge codes (needed by e.g. rDock)
+        :param buffer_size: Size of the output buffer in bytes
+        """
+        self.legacy_charges = legacy_charges
+        self.out = open_output(outfile, buffer_size=buffer_size)
+        # property block templates, keyed by the tuple of property names
+        self.templates = {}
+
+    def get_template(self, names):
+        template = self.templates.get(names)
+        if template is None:
+            template = ''.join(['>  <' + name.replace('{', '{{').replace('}', '}}') + '>  \n{}\n\n' for name in names])
+            template += '$$$$\n'
+            self.templates[names] = template
+        return template
+
+    def format_record(self, smiles, mol, mol_id, prop_names, new_props, smiles_prop_name=None, raw=None):
+        if raw is not None:
+            # write back the original record, adding the new properties
+            names = tuple([name for name in prop_names if name is not None])
+            values = ['' if value is None else value for name, value in zip(prop_names, new_props) if name is not None]
+            raw = raw[:raw.rfind('$$$$')]
+            if any(['<' + name + '>' in raw for name in names]):
+                # the record already has some of the properties (e.g. from a previous run), replace them
+                raw = remove_data_items(raw, names)
+            return raw + self.get_template(names).format(*values)
         if not mol:
             mol = Chem.MolFromSmiles(smiles)
         if mol_id is not None:
             mol.SetProp('_Name', mol_id)
+        # the new values replace any existing properties of the same name
+        props = {name: mol.GetProp(name) for name in mol.GetPropNames()}
         if smiles_prop_name is not None:
-            mol.SetProp(smiles_prop_name, smiles)
-        if not prop_names:
-            prop_names = []
-        if not new_props:
-            new_props = []
-            
-        for i, prop_name in enumerate(prop_names):
-            value = new_props[i]
+            props[smiles_prop_name] = smiles
+        for prop_name, value in zip(prop_names, new_props):
             if prop_name is not None:
-                mol.SetProp(prop_name, str(value))
+                props[prop_name] = '' if value is None else value
 
-        self.writer.write(mol)
+        molblock = Chem.MolToMolBlock(mol)
+        if self.legacy_charges:
+            molblock = updateChargeFlagInAtomBlock(molblock)
+        return molblock + self.get_template(tuple(props)).format(*props.values())
+
+    def write(self, smiles=None, mol=None, mol_id=None, existing_props=None, prop_names=None, new_props=None, smiles_prop_name=None):
+        self.out.write(self.format_record(smiles, mol, mol_id, prop_names or [], new_props or [],
+                                          smiles_prop_name=smiles_prop_name))
+
+    def write_batch(self, records, prop_names=None):
+        """
+        Write a batch of records.
+        :param records: List of (smiles, mol, mol_id, existing_props, new_props, raw) tuples. If raw (the text of the
+                        SD record that was read) is not None it is written with the new properties added
+        :param prop_names: The names of the new properties, the same for all records
+        """
+        if not prop_names:
+            prop_names = []
+        self.out.write(''.join([self.format_record(smiles, mol, mol_id, prop_names, new_props or [], raw=raw)
+                                for smiles, mol, mol_id, existing_props, new_props, raw in records]))
 
     def write_header(self, values):
         utils.log("INFO: asked to write header for an SDF. No action will be taken.")
 
     def close(self):
-        self.writer.close()
-        if self.gzip:
-            self.gzip.close()
+        self.out.close()
+
+
+def remove_data_items(record, names):
+    """
+    Remove data items from the text of an SD record.
+    :param record: The text of the record, without the $$$$ line
+    :param names: The names of the data items to remove
+    :return: The text of the record without those items
+    """
+    end = record.find('M  END')
+    if end < 0:
+        return record
+    end = record.find('\n', end) + 1
+    lines = []
+    skipping = False
+    for line in record[end:].splitlines(keepends=True):
+        # an item runs up to the next header line
+        match = data_header_pattern.match(line)
+        if match:
+            skipping = match.group(1) in names
+        if not skipping:
+            lines.append(line)
+    return record[:end] + ''.join(lines)
 
 
 class SmilesWriter:
 
-    def __init__(self, outfile, sep):
-        self.writer = open(outfile, 'w')
+    def __init__(self, outfile, sep, buffer_size=default_buffer_size):
+        self.writer = open(outfile, 'w', buffering=buffer_size)
         if sep is None:
             self.sep = ' '
         else:
@@ -68,36 +160,294 @@ class SmilesWriter:
         line = self.sep.join(values)
         self.writer.write(line + "\n")
 
+    def format_record(self, smiles, existing_props, new_props, raw=None):
+        if raw is not None:
+            # the original line, which holds the SMILES and the existing values
+            values = [raw]
+            existing_props = None
+        else:
+            values = [smiles]
+        if existing_props:
+            values.extend(['' if prop is None else prop for prop in existing_props])
+        if new_props:
+            values.extend(['' if prop is None else str(prop) for prop in new_props])
+        return self.sep.join(values)
+
     def write(self, smiles=None, mol=None, mol_id=None, existing_props=None, prop_names=None, new_props=None, smiles_prop_name=None):
-        values = [smiles]
-        if not existing_props:
-            existing_props = []
-        if not prop_names:
-            prop_names = []
-        if not new_props:
-            new_props = []
-            
-        for prop in existing_props:
-            if prop is not None:
-                values.append(prop)
-            else:
-                values.append('')
+        self.writer.write(self.format_record(smiles, existing_props, new_props) + "\n")
+
+    def write_batch(self, records, prop_names=None):
+        """
+        Write a batch of records.
+        :param records: List of (smiles, mol, mol_id, existing_props, new_props, raw) tuples. If raw (the line that
+                        was read) is not None it is written in place of the SMILES and the existing values
+        :param prop_names: Not used
+        """
+        if records:
+            self.writer.write("\n".join([self.format_record(smiles, existing_props, new_props, raw=raw)
+                                         for smiles, mol, mol_id, existing_props, new_props, raw in records]) + "\n")
+
+    def close(self):
+        self.writer.close()
+
+
+class ColumnarWriter:
+    """
+    Writes the results as a table with typed columns (CSV, Parquet or Arrow IPC).
+    The rows are buffered and written in chunks (row groups for Parquet, record batches for Arrow) so that the
+    memory used stays bounded.
+    """
+
+    formats = ('csv', 'parquet', 'arrow')
+
+    def __init__(self, outfile, format, chunk_size=10000, buffer_size=default_buffer_size):
+        if format not in self.formats:
+            raise ValueError('Unexpected columnar format', format)
+        if format != 'csv' and pa is None:
+            raise ValueError('pyarrow is needed to write ' + format + ' files')
+        self.outfile = outfile
+        self.format = format
+        self.chunk_size = chunk_size
+        self.names = None
+        self.num_existing = None
+        self.rows = []
+        self.schema = None
+        self.writer = None
+        if format == 'csv':
+            self.out = open_output(outfile, buffer_size=buffer_size)
+        else:
+            self.out = None
 
-        for prop in new_props:
-            if prop is not None:
-                values.append(str(prop))
+    def write_header(self, values):
+        self.names = list(values)
+
+    def write(self, smiles=None, mol=None, mol_id=None, existing_props=None, prop_names=None, new_props=None, smiles_prop_name=None):
+        self.write_batch([(smiles, mol, mol_id, existing_props, new_props, None)], prop_names=prop_names)
+
+    def write_batch(self, records, prop_names=None):
+        """
+        Write a batch of records.
+        :param records: List of (smiles, mol, mol_id, existing_props, new_props, raw) tuples. raw is not used
+        :param prop_names: The names of the new properties, used for the column names if no header was written
+        """
+        for smiles, mol, mol_id, existing_props, new_props, raw in records:
+            existing_props = existing_props or []
+            if self.names is None:
+                self.names = generate_header_values(None, len(existing_props), prop_names or [])
+            if self.num_existing is None:
+                self.num_existing = len(existing_props)
+            row = [smiles]
+            row.extend(existing_props)
+            row.extend(new_props or [])
+            self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def column_type(self, index, name, inferred):
+        """
+        Get the type of a column. This is fixed by the first chunk, so where the name tells us the type of the values
+        that is used rather than what was in that chunk, as a column can be all null there (e.g. a model that could
+        not be applied to the first molecules) and have values later.
+        :param index: The column index
+        :param name: The column name
+        :param inferred: The type pyarrow inferred from the first chunk
+        :return: The pyarrow type
+        """
+        # the SMILES and the existing fields are always text
+        if index <= self.num_existing:
+            return pa.string()
+        if name.endswith('_DOA'):
+            return pa.bool_()
+        if self.is_class_column(index, name):
+            return pa.int64()
+        if name.endswith(('_Prediction', '_Inactive', '_Active')) or name == 'Score':
+            return pa.float64()
+        if pa.types.is_null(inferred):
+            return pa.float64()
+        return inferred
+
+    def is_class_column(self, index, name):
+        """
+        Whether the column holds the predicted classes of a classification model, which has the probabilities of
+        the classes in the <Model>_Inactive and <Model>_Active columns.
+        """
+        return index > self.num_existing and name.endswith('_Prediction') and \
+            name[:-len('_Prediction')] + '_Active' in self.names
+
+    def create_schema(self, inferred):
+        return pa.schema([pa.field(field.name, self.column_type(i, field.name, field.type))
+                          for i, field in enumerate(inferred)])
+
+    def flush(self):
+        if not self.rows:
+            return
+        df = pd.DataFrame(self.rows, columns=self.names).infer_objects()
+        self.rows = []
+        # the SMILES and the existing fields are always text
+        for name in self.names[:self.num_existing + 1]:
+            df[name] = df[name].astype(object)
+        # the classes stay integers when there are missing values
+        for i, name in enumerate(self.names):
+            if self.is_class_column(i, name):
+                df[name] = df[name].astype('Int64')
+
+        if self.format == 'csv':
+            df.to_csv(self.out, header=self.schema is None, index=False)
+            self.schema = True
+            return
+
+        if self.schema is None:
+            self.schema = self.create_schema(pa.Table.from_pandas(df, preserve_index=False).schema)
+            if self.format == 'parquet':
+                self.writer = pa.parquet.ParquetWriter(self.outfile, self.schema)
             else:
-                values.append('')
-        line = self.sep.join(values)
-        self.writer.write(line + "\n")
+                self.writer = pa.ipc.new_file(self.outfile, self.schema)
+        # the columns of each chunk are cast to the types of the schema, so nulls and ints are accepted in any chunk
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = pa.Table.from_arrays([column.cast(field.type) for column, field in zip(table.columns, self.schema)],
+                                     schema=self.schema)
+        self.writer.write_table(table)
 
     def close(self):
-        self.writer.close()
+        self.flush()
+        if self.writer:
+            self.writer.close()
+        if self.out:
+            self.out.close()
+
+
+class RejectsWriter:
+    """
+    Collects the records that could not be read. They are optionally written, in batches, to a tab separated
+    sidecar file (record number, reason, raw text) and summarised with events that are emitted at most every
+    report_interval seconds, with the counts by reason.
+    """
+
+    def __init__(self, outfile=None, report_interval=60, batch_size=1000):
+        self.out = open_output(outfile) if outfile else None
+        if self.out:
+            self.out.write('record\tsource\treason\traw\n')
+        self.report_interval = report_interval
+        self.batch_size = batch_size
+        self.lines = []
+        self.counts = Counter()
+        self.reported = 0
+        self.last_report = time.time()
+
+    def add(self, error, source=''):
+        """
+        Add a rejected record.
+        :param error: The exception raised by the reader, normally a RecordError
+        :param source: The input file name
+        """
+        reason = getattr(error, 'reason', None) or type(error).__name__
+        self.counts[reason] += 1
+        if self.out:
+            raw = getattr(error, 'raw', None) or ''
+            # keep one line per record, SD records are multi-line
+            raw = raw.replace('\\', '\\\\').replace('\n', '\\n').replace('\t', '\\t')
+            self.lines.append(f'{getattr(error, "record_number", "")}\t{source}\t{reason}\t{raw}\n')
+            if len(self.lines) >= self.batch_size:
+                self.flush()
+        if time.time() - self.last_report >= self.report_interval:
+            self.report()
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def report(self):
+        """Emit an event summarising the rejected records, if there are new ones"""
+        self.last_report = time.time()
+        total = self.total()
+        if total > self.reported:
+            self.reported = total
+            reasons = ', '.join([f'{reason}: {count}' for reason, count in self.counts.most_common()])
+            DmLog.emit_event(f'{total} records rejected ({reasons})')
+
+    def flush(self):
+        if self.lines:
+            self.out.write(''.join(self.lines))
+            self.lines = []
+
+    def close(self):
+        if self.out:
+            self.flush()
+            self.out.close()
+        self.report()
+
+
+class RecordError(TypeError):
+    """
+    Raised by the readers for a record that cannot be read. It is a TypeError so that existing handlers still catch
+    it, but also holds the record number, the raw text (if available) and the reason.
+    """
+
+    def __init__(self, reader, record_number, reason, raw=None):
+        super().__init__(f'{reader}: {reason} (record {record_number})')
+        self.record_number = record_number
+        self.reason = reason
+        self.raw = raw
+
+
+class Record:
+    """
+    A record generated by the readers. The canonical SMILES (for SDF inputs) and the list of property values are
+    generated when first needed. The raw text of the record (the SMILES line or the SD record) is kept if the reader
+    was asked to, so that the writers can write it back without serialising the molecule.
+    For compatibility a record can be unpacked as a (mol, smiles, id, props) tuple.
+    """
+
+    __slots__ = ('mol', 'id', 'raw', '_smiles', '_props', '_field_names')
+
+    def __init__(self, mol, smiles=None, id=None, props=None, raw=None, field_names=None):
+        """
+        :param smiles: The SMILES. If None it is generated from the molecule
+        :param props: The property values. If None they are read from the molecule using field_names
+        """
+        self.mol = mol
+        self.id = id
+        self.raw = raw
+        self._smiles = smiles
+        self._props = props
+        self._field_names = field_names
+
+    @property
+    def smiles(self):
+        if self._smiles is None:
+            self._smiles = Chem.MolToSmiles(self.mol)
+        return self._smiles
+
+    @property
+    def props(self):
+        if self._props is None:
+            mol = self.mol
+            self._props = [mol.GetProp(name) if mol.HasProp(name) else None for name in self._field_names]
+        return self._props
+
+    def release_mol(self, keep_smiles=True, keep_props=True):
+        """
+        Release the molecule once it is no longer needed, generating the SMILES and the property values first
+        if they will still be needed.
+        """
+        if keep_smiles:
+            _ = self.smiles
+        if keep_props:
+            _ = self.props
+        self.mol = None
+
+    def __iter__(self):
+        return iter((self.mol, self.smiles, self.id, self.props))
+
+    def __str__(self):
+        return f'{self.__class__}: {self.id}'
 
 
 class SdfReader:
 
-    def __init__(self, input_file, id_col, recs_to_read):
+    def __init__(self, input_file, id_col, recs_to_read, keep_raw=False):
+        """
+        :param keep_raw: Keep the text of each record in the Records (see Record.raw)
+        """
 
         self.field_names = []
         # read a number of records to determine the field names
@@ -118,7 +468,14 @@ class SdfReader:
                         break
 
         # now create the real reader
-        self.reader = self.create_reader(input_file)
+        self.record_number = 0
+        self.keep_raw = keep_raw
+        if keep_raw:
+            self.handle = gzip.open(input_file, 'rt') if input_file.endswith('.gz') else open(input_file, 'rt')
+            self.reader = self.text_records(self.handle)
+        else:
+            self.handle = None
+            self.reader = self.create_reader(input_file)
         self.id_col = id_col
 
 
@@ -130,26 +487,68 @@ class SdfReader:
             reader = Chem.ForwardSDMolSupplier(input_file)
         return reader
 
+    @staticmethod
+    def text_records(handle):
+        """Generate the text of the SD records"""
+        lines = []
+        for line in handle:
+            lines.append(line)
+            if line.startswith('$$$$'):
+                yield ''.join(lines)
+                lines = []
+        # like RDKit, a last record without the $$$$ line is still read
+        if any([line.strip() for line in lines]):
+            text = ''.join(lines)
+            if not text.endswith('\n'):
+                text += '\n'
+            yield text + '$$$$\n'
+
+    @staticmethod
+    def parse_record(text):
+        """Create a molecule from the text of a SD record, including the data fields"""
+        mol = Chem.MolFromMolBlock(text)
+        if mol:
+            end = text.find('M  END')
+            lines = text[end:].split('\n')[1:]
+            name = None
+            values = []
+            for line in lines:
+                if line.startswith('$$$$'):
+                    break
+                if name is None:
+                    if line.startswith('>'):
+                        start = line.find('<')
+                        name = line[start + 1:line.find('>', start + 1)]
+                elif line.strip():
+                    values.append(line)
+                else:
+                    mol.SetProp(name, '\n'.join(values))
+                    name = None
+                    values = []
+            if name is not None:
+                # the last item of a record without the blank line
+                mol.SetProp(name, '\n'.join(values))
+        return mol
+
     def read(self):
         try:
-            props = []
-            mol = next(self.reader)
+            if self.keep_raw:
+                raw = next(self.reader)
+                mol = self.parse_record(raw)
+            else:
+                raw = None
+                mol = next(self.reader)
+            self.record_number += 1
             if not mol:
-                raise TypeError(f'{self}: Error parsing molecule')
-            smi = Chem.MolToSmiles(mol)
+                raise RecordError(self, self.record_number, 'Error parsing molecule', raw=raw)
                 
             if self.id_col:
                 id = mol.GetProp(self.id_col)
             else:
                 id = None
 
-            for name in self.field_names:
-                if mol.HasProp(name):
-                    props.append(mol.GetProp(name))
-                else:
-                    props.append(None)
-            t = (mol, smi, id, props)
-            return t
+            # the SMILES and the property values are generated if needed
+            return Record(mol, id=id, raw=raw, field_names=self.field_names)
 
         except StopIteration as ex:
             raise StopIteration from ex
@@ -158,7 +557,8 @@ class SdfReader:
         return self.field_names
 
     def close(self):
-        pass
+        if self.handle:
+            self.handle.close()
 
     def __str__(self):
         return str(self.__class__)
@@ -166,12 +566,22 @@ class SdfReader:
 
 class SmilesReader:
 
-    def __init__(self, input_file, read_header, delimiter, id_col):
+    def __init__(self, input_file, read_header, delimiter, id_col, mol_props=True, keep_raw=False, validate=False):
+        """
+        :param mol_props: Set the extra columns as properties of the molecule. These are only needed when writing SDF,
+                          the other writers use the list of column values.
+        :param keep_raw: Keep the text of each line in the Records (see Record.raw)
+        :param validate: Reject SMILES with characters that cannot be in a SMILES before parsing them with RDKit
+        """
         if input_file.endswith('.gz'):
             self.reader = gzip.open(input_file, 'rt')
         else:
             self.reader = open(input_file, 'rt')
         self.delimiter = delimiter
+        self.mol_props = mol_props
+        self.keep_raw = keep_raw
+        self.validate = validate
+        self.line_number = 0
         if id_col is None:
             self.id_col = None
         else:
@@ -180,27 +590,25 @@ class SmilesReader:
         # skip header lines
         if read_header:
             line = self.reader.readline()
-            tokens = self.tokenize(line)
-            self.field_names = []
-            for token in tokens:
-                self.field_names.append(token.strip())
+            self.line_number += 1
+            self.field_names = self.tokenize(line)
 
     def tokenize(self, line):
-        line = line.strip()
         if self.delimiter is None:
-            tokens = line.split()
-        else:
-            tokens = line.split(self.delimiter)
-        stripped = []
-        for token in tokens:
-            stripped.append(token.strip())
-        return stripped
+            # split() with no separator already discards the surrounding whitespace
+            return line.split()
+        return [token.strip() for token in line.strip().split(self.delimiter)]
 
     def read(self):
         line = self.reader.readline()
         if line:
+            self.line_number += 1
             tokens = self.tokenize(line)
+            if not tokens or not tokens[0]:
+                raise RecordError(self, self.line_number, 'Empty SMILES', raw=line.rstrip('\r\n'))
             smi = tokens[0]
+            if self.validate and not smiles_pattern.match(smi):
+                raise RecordError(self, self.line_number, 'Invalid SMILES characters', raw=line.rstrip('\r\n'))
             if self.id_col:
                 id = tokens[self.id_col]
             else:
@@ -208,22 +616,18 @@ class SmilesReader:
 
             mol = Chem.MolFromSmiles(smi)
             if not mol:
-                raise TypeError(f'{self}: Error parsing molecule')            
-            props = []
-
-            for i, token in enumerate(tokens):
-                token = token.strip()
-                if i != 0:
-                    props.append(token)
-                    if mol:
-                        if self.field_names:
-                            mol.SetProp(self.field_names[i], token)
-                        else:
-                            mol.SetProp('field' + str(i), token)
-
-
-            t = (mol, smi, id, props)
-            return t
+                raise RecordError(self, self.line_number, 'Error parsing molecule', raw=line.rstrip('\r\n'))
+            props = tokens[1:]
+
+            if self.mol_props:
+                if self.field_names:
+                    for name, token in zip(self.field_names[1:], props):
+                        mol.SetProp(name, token)
+                else:
+                    for i, token in enumerate(props, 1):
+                        mol.SetProp('field' + str(i), token)
+
+            return Record(mol, smiles=smi, id=id, props=props, raw=line.rstrip('\r\n') if self.keep_raw else None)
         else:
             raise StopIteration
 
@@ -255,26 +659,59 @@ def generate_header_values(extra_field_names, num_orig_props, calc_prop_names):
     return headers
 
 
-def create_reader(input_file, type=None, id_column=None, sdf_read_records=100, read_header=False, delimiter='\t'):
+def is_sdf(filename):
+    """Does the file name look like a SD file (optionally gzipped)"""
+    return filename.endswith('.sdf') or filename.endswith('.sdf.gz') or filename.endswith('.sd') or filename.endswith('.sd.gz')
+
+
+def create_reader(input_file, type=None, id_column=None, sdf_read_records=100, read_header=False, delimiter='\t',
+                  mol_props=True, keep_raw=False, validate=False):
+    """
+    Create a reader for the input file. The readers generate Records and raise RecordError for bad records.
+    :param mol_props: For SMILES inputs, whether to set the extra columns as molecule properties.
+                      Only needed when the output is SDF.
+    :param keep_raw: Keep the text of each record so that it can be written back as is (see can_pass_through)
+    :param validate: For SMILES inputs, reject obviously invalid SMILES before parsing them
+    """
     if type is None:
-        if input_file.endswith('.sdf') or input_file.endswith('.sdf.gz') or input_file.endswith('.sd') or input_file.endswith('.sd.gz'):
+        if is_sdf(input_file):
             type = 'sdf'
         else:
             type = 'smi'
 
     if type == 'sdf':
-        return SdfReader(input_file, id_column, sdf_read_records)
+        return SdfReader(input_file, id_column, sdf_read_records, keep_raw=keep_raw)
     elif type == 'smi':
-        return SmilesReader(input_file, read_header, delimiter, id_column)
+        return SmilesReader(input_file, read_header, delimiter, id_column, mol_props=mol_props, keep_raw=keep_raw,
+                            validate=validate)
     else:
         raise ValueError('Unexpected file type', type)
 
 
-def create_writer(outfile, delimiter='\t'):
-    if outfile.endswith('.sdf') or outfile.endswith('sd'):
-        return SdfWriter(outfile)
+def can_pass_through(input_file, writer, delimiter, id_column=None):
+    """
+    Can the writer write back the raw text of the records read from the input file (see Record.raw)?
+    This is the case for SDF to SDF (unless the name is set from a field or legacy charges are written) and for
+    SMILES to SMILES with the same delimiter.
+    """
+    if isinstance(writer, SdfWriter):
+        return is_sdf(input_file) and id_column is None and not writer.legacy_charges
+    if isinstance(writer, SmilesWriter):
+        return not is_sdf(input_file) and delimiter is not None and delimiter == writer.sep
+    return False
+
+
+def create_writer(outfile, delimiter='\t', legacy_charges=False, buffer_size=default_buffer_size):
+    if is_sdf(outfile):
+        return SdfWriter(outfile, legacy_charges=legacy_charges, buffer_size=buffer_size)
+    elif outfile.endswith('.csv') or outfile.endswith('.csv.gz'):
+        return ColumnarWriter(outfile, 'csv', buffer_size=buffer_size)
+    elif outfile.endswith('.parquet'):
+        return ColumnarWriter(outfile, 'parquet')
+    elif outfile.endswith('.arrow'):
+        return ColumnarWriter(outfile, 'arrow')
     else:
-        return SmilesWriter(outfile, delimiter)
+        return SmilesWriter(outfile, delimiter, buffer_size=buffer_size)
 
 
 def updateChargeFlagInAtomBlock(mb):
@@ -285,72 +722,7 @@ def updateChargeFlagInAtomBlock(mb):
     This function is based on work by Jose Manuel Gally that can be found here:
     See https://sourceforge.net/p/rdkit/mailman/message/36425493/
     """
-    f="{:>10s}"*3+"{:>2}{:>4s}"+"{:>3s}"*11
-    chgs = []    # list of charges
-    lines = mb.split("\n")
-    #if mb[0] == '' or mb[0] == "\n":
-    #    del lines[0]
-    CTAB = lines[3]
-    atomCount = int(CTAB.split()[0])
-    # parse mb line per line
-    for l in lines:
-        # look for M CHG property
-        if l[0:6] == "M  CHG":
-            records = l.split()[3:]    # M  CHG X is not needed for parsing, the info we want comes afterwards
-            # record each charge into a list
-            for i in range(0,len(records),2):
-                idx = records[i]
-                chg = records[i+1]
-                chgs.append((int(idx), int(chg)))    # sort tuples by first element?
-            break    # stop iterating
-
-    # sort by idx in order to parse the molblock only once more
-    chgs = sorted(chgs, key=lambda x: x[0])
-
-    # that we have a list for the current molblock, attribute each charges
-    for chg in chgs:
-        i=4
-        while i < 4+atomCount:    # do not read from beginning each time, rather continue parsing mb!
-            # when finding the idx of the atom we want to update, extract all fields and rewrite whole sequence
-            if i-3 == chg[0]:    # -4 to take into account the CTAB headers, +1 because idx begin at 1 and not 0
-                fields = lines[i].split()
-                x=fields[0]
-                y=fields[1]
-                z=fields[2]
-                symb=fields[3]
-                massDiff=fields[4]
-                charge=fields[5]
-                sp=fields[6]
-                hc=fields[7]
-                scb=fields[8]
-                v=fields[9]
-                hd=fields[10]
-                nu1=fields[11]
-                nu2=fields[12]
-                aamn=fields[13]
-                irf=fields[14]
-                ecf=fields[15]
-                # update charge flag
-                if chg[1] == -1:
-                    charge = '5'
-                elif chg[1] == -2:
-                    charge = '6'
-                elif chg[1] == -3:
-                    charge = '7'
-                elif chg[1] == 1:
-                    charge = '3'
-                elif chg[1] == 2:
-                    charge = '2'
-                elif chg[1] == 3:
-                    charge = '1'
-                else:
-                    utils.log("ERROR! " + str(lines[0]) + "unknown charge flag: " + str(chg[1]))
-                    break
-                # update modatom block line
-                lines[i] = f.format(x,y,z,symb,massDiff,charge,sp,hc,scb,v,hd,nu1,nu2,aamn,irf,ecf)
-            i+=1
-    upmb = "\n".join(lines)
-    return(upmb)
+    return utils.UpdateChargeFlagInAtomBlock(mb)
 
 
 def get_num_chiral_centers(mol):
@@ -411,13 +783,25 @@ def rdk_read_mols(input_file):
     """
     Read molecules from a single file (.mol or .sdf)
     """
+    return list(rdk_iter_mols(input_file))
+
+
+def rdk_iter_mols(input_file):
+    """
+    Generate the molecules from a single file (.mol, .sdf or .sdf.gz) without reading them all into memory.
+    Molecules that cannot be parsed are generated as None. The file is closed once all molecules are read (or the
+    generator is closed).
+    """
     if input_file.endswith('.mol'):
-        mol = Chem.MolFromMolFile(input_file)
-        return [mol]
+        yield Chem.MolFromMolFile(input_file)
+    elif input_file.endswith('.sdf'):
+        with open(input_file, 'rb') as f:
+            yield from Chem.ForwardSDMolSupplier(f)
+    elif input_file.endswith('.sdf.gz'):
+        with gzip.open(input_file, 'rb') as gz:
+            yield from Chem.ForwardSDMolSupplier(gz)
     else:
-        supplr = rdk_mol_supplier(input_file)
-        mols = [m for m in supplr]
-        return mols
+        raise ValueError('Unsupported file type. Must be .mol .sdf or .sdf.gz. Found ' + input_file)
 
 
 def rdk_read_molecule_files(inputs):
@@ -435,41 +819,47 @@ def rdk_read_molecule_files(inputs):
     :param input_files: Input_File filenames
     :return: List of molecules that have been read
     """
-    mols = []
+    return list(rdk_iter_molecule_files(inputs))
+
+
+def rdk_iter_molecule_files(inputs):
+    """
+    Generate the input molecules. The inputs are specified as for rdk_read_molecule_files but the molecules are
+    read lazily, one file after the other. Molecules that cannot be read are reported and skipped.
+
+    :param input_files: Input_File filenames
+    :return: Generator of the molecules
+    """
     for input_file in inputs:
         tokens = input_file.split(',')
         for token in tokens:
             if token.endswith('.mol'):
                 m = Chem.MolFromMolFile(token)
                 if m:
-                    mols.append(m)
+                    yield m
                 else:
                     DmLog.emit_event('WARNING: could not process', token)
             else:
-                ms = rdk_read_mols(token)
-                for i, m in enumerate(ms):
+                for i, m in enumerate(rdk_iter_mols(token)):
                     if m:
-                        mols.append(m)
+                        yield m
                     else:
                         DmLog.emit_event('WARNING: could not process molecule', i, 'from', token)
-    return mols
 
 
 def rdk_merge_mols(inputs):
     """
-    Merge multiple molecules into a single molecule
+    Merge multiple molecules into a single molecule. The molecules are read from the files as a stream.
     :param input_file:
-    :return:
+    :return: Tuple of the merged molecule and the number of molecules merged
     """
     merged_mol = Chem.RWMol()
-    mols = rdk_read_molecule_files(inputs)
-    for i, mol in enumerate(mols):
-        if mol:
-            merged_mol.InsertMol(mol)
-        else:
-            DmLog.emit_event('WARNING: could not process molecule', i)
+    count = 0
+    for mol in rdk_iter_molecule_files(inputs):
+        merged_mol.InsertMol(mol)
+        count += 1
     Chem.SanitizeMol(merged_mol)
-    return merged_mol, i + 1
+    return merged_mol, count
 
 
 def rdk_mol_supplier(input_file):
@@ -487,46 +877,64 @@ def rdk_mol_supplier(input_file):
 
 
 def fragment(mol, mode):
-    frags = Chem.GetMolFrags(mol, asMols=True)
+    """
+    Get the biggest fragment of the molecule, eliminating salts etc.
+    The fragments are compared as atom index tuples and only the chosen fragment is extracted, keeping the
+    properties of the molecule. Ties are resolved by choosing the first fragment (in atom order).
+
+    :param mol: The molecule
+    :param mode: How to choose the fragment, by heavy atom count (hac) or molecular weight (mw)
+    :return: The biggest fragment, or the molecule itself if it has only one fragment
+    """
+    frags = Chem.GetMolFrags(mol)
 
     if len(frags) == 1:
         return mol
+
+    if mode == 'hac':
+        heavy = [atom.GetAtomicNum() > 1 for atom in mol.GetAtoms()]
+        sizes = [sum([heavy[i] for i in frag]) for frag in frags]
+    elif mode == 'mw':
+        masses = [atom.GetMass() + atom.GetTotalNumHs() * hydrogen_mass for atom in mol.GetAtoms()]
+        sizes = [sum([masses[i] for i in frag]) for frag in frags]
     else:
-        # TODO - handle ties
-        biggest_index = -1
-        i = 0
-        if mode == 'hac':
-            biggest_count = 0
-            for frag in frags:
-                hac = frag.GetNumHeavyAtoms()
-                if hac > biggest_count:
-                    biggest_count = hac
-                    biggest_mol = frag
-                    biggest_index = i
-                i+=1
-            utils.log("Chose fragment", biggest_index, "from", len(frags), "based on HAC")
-        elif mode == 'mw':
-            biggest_mw = 0
-            for frag in frags:
-                mw = Descriptors.MolWt(frag)
-                if mw > biggest_mw:
-                    biggest_mw = mw
-                    biggest_mol = frag
-                    biggest_index = i
-                i+=1
-            utils.log("Chose fragment", biggest_index, "from", len(frags), "based on MW")
-        else:
-            raise ValueError('Invalid fragment mode:',mode)
+        raise ValueError('Invalid fragment mode:', mode)
+
+    # max() returns the first of equal values, so ties are deterministic
+    biggest_index = max(range(len(frags)), key=sizes.__getitem__)
+    logging.debug("Chose fragment %s from %s based on %s", biggest_index, len(frags), mode.upper())
+
+    return extract_atoms(mol, frags[biggest_index])
+
 
-        # copy the properties across
-        for name in mol.GetPropNames():
-            biggest_mol.SetProp(name, mol.GetProp(name))
+def fragment_mols(mols, mode):
+    """
+    Get the biggest fragment of each of the molecules. None values are passed through.
+    :param mols: List of molecules
+    :param mode: How to choose the fragment, by heavy atom count (hac) or molecular weight (mw)
+    :return: List of fragments
+    """
+    return [fragment(mol, mode) if mol else mol for mol in mols]
 
-        # _Name is a magical property that is not in the ones returned by GetPropNames
-        if '_Name' in mol.GetPropNames():
-            biggest_mol.SetProp("_Name", mol.GetProp("_Name"))
 
-        return biggest_mol
+def extract_atoms(mol, atom_indices):
+    """
+    Create a copy of the molecule (including its properties) that only contains the specified atoms.
+    :param mol: The molecule
+    :param atom_indices: The indices of the atoms to keep, typically a fragment from Chem.GetMolFrags()
+    :return: The new molecule
+    """
+    keep = set(atom_indices)
+    rwmol = Chem.RWMol(mol)
+    rwmol.BeginBatchEdit()
+    for i in range(mol.GetNumAtoms()):
+        if i not in keep:
+            rwmol.RemoveAtom(i)
+    rwmol.CommitBatchEdit()
+    frag = rwmol.GetMol()
+    # removing atoms resets the ring information
+    Chem.GetSymmSSSR(frag)
+    return frag
 
 
 def fragmentAndFingerprint(reader, mols, data, fps, descriptor, fragmentMethod='hac', outputFragment=False):
@@ -567,3 +975,120 @@ def fragmentAndFingerprint(reader, mols, data, fps, descriptor, fragmentMethod='
             fps.append(d)
             continue
     return errors
+
+
+def fragmentAndFingerprintMatrix(reader, descriptor, fragmentMethod='hac', outputFragment=False, keepMols=False,
+                                 counts=False, chunkSize=1000, processes=1, initialCapacity=1024):
+    """
+    Fragment the molecules if they have multiple fragments and generate fingerprints on the fragments into a NumPy
+    matrix. This is an alternative to fragmentAndFingerprint that avoids keeping one RDKit fingerprint object per
+    molecule. Each row holds the bits of a fingerprint packed with numpy.packbits (uint8), or the counts (float32)
+    when counts is True. The matrix is preallocated and grown as needed.
+
+    :param reader: Reader (see create_reader) from which to read the molecules
+    :param descriptor: Function to generate the fingerprint from the molecule. Must be a module level function
+                       when using multiple processes
+    :param fragmentMethod: The fragmentation method to use when there are multiple fragments (hac or mw)
+    :param outputFragment: Boolean that specifies whether to use the fragment or the original molecule for the
+                           SMILES (and the molecules if keepMols is True)
+    :param keepMols: Also return the molecules. If False only the IDs, SMILES and properties are kept
+    :param counts: The descriptor generates count fingerprints, which are stored as float32 rather than packed bits
+    :param chunkSize: The number of molecules processed at a time
+    :param processes: The number of processes to use for generating the fingerprints
+    :param initialCapacity: The initial number of rows of the matrix
+    :return: Tuple of the matrix, the list of (id, smiles, props) tuples, the list of molecules (None unless
+             keepMols is True) and the number of errors encountered
+    """
+    args = (descriptor, fragmentMethod, outputFragment, keepMols, counts)
+    matrix = None
+    size = 0
+    data = []
+    mols = [] if keepMols else None
+    errors = 0
+
+    def add_rows(rows):
+        nonlocal matrix
+        if matrix is None:
+            matrix = np.empty((max(initialCapacity, len(rows)), rows.shape[1]), dtype=rows.dtype)
+        elif size + len(rows) > len(matrix):
+            grown = np.empty((max(2 * len(matrix), size + len(rows)), matrix.shape[1]), dtype=matrix.dtype)
+            grown[:size] = matrix[:size]
+            matrix = grown
+        matrix[size:size + len(rows)] = rows
+
+    chunks = _read_chunks(reader, chunkSize)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_fingerprint_chunk, ((chunk, args) for chunk in chunks))
+    else:
+        pool = None
+        results = (_fingerprint_chunk((chunk, args)) for chunk in chunks)
+
+    try:
+        for rows, chunk_data, chunk_mols, chunk_errors in results:
+            errors += chunk_errors
+            if rows is not None:
+                add_rows(rows)
+                size += len(rows)
+                data.extend(chunk_data)
+                if keepMols:
+                    mols.extend(chunk_mols)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if matrix is None:
+        matrix = np.empty((0, 0), dtype=np.float32 if counts else np.uint8)
+    else:
+        # release the unused capacity
+        matrix = matrix[:size].copy()
+    return matrix, data, mols, errors
+
+
+def _read_chunks(reader, chunkSize):
+    """Generate lists of (mol, id, props) tuples from the reader. Molecules that cannot be read are None"""
+    chunk = []
+    while True:
+        try:
+            record = reader.read()
+        except TypeError:
+            chunk.append((None, None, None))
+            continue
+        except StopIteration:
+            break
+        chunk.append((record.mol, record.id, record.props))
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _fingerprint_chunk(job):
+    """Fragment and fingerprint a chunk of molecules. Run in the worker processes"""
+    chunk, (descriptor, fragmentMethod, outputFragment, keepMols, counts) = job
+    rows = []
+    data = []
+    mols = []
+    errors = 0
+    for mol, id, props in chunk:
+        if not mol:
+            errors += 1
+            continue
+        frag = fragment(mol, fragmentMethod)
+        d = descriptor(frag)
+        if d:
+            arr = np.zeros((0,), dtype=np.float32 if counts else np.uint8)
+            DataStructs.ConvertToNumpyArray(d, arr)
+            rows.append(arr)
+            m = frag if outputFragment else mol
+            data.append((id, Chem.MolToSmiles(m), props))
+            if keepMols:
+                mols.append(m)
+    if not rows:
+        return None, data, mols, errors
+    matrix = np.stack(rows)
+    if not counts:
+        matrix = np.packbits(matrix, axis=1)
+    return matrix, data, mols, errors
@@ -37,78 +37,46 @@ def expand_path(path):
             os.makedirs(head_tail[0], exist_ok=True)
 
 
+# legacy atom block charge codes, keyed by formal charge
+legacy_charge_flags = {3: '  1', 2: '  2', 1: '  3', -1: '  5', -2: '  6', -3: '  7'}
+
+
 def UpdateChargeFlagInAtomBlock(mb):
     """
+    Add the deprecated charge codes to the atom block of a V2000 molblock (or SD record) using the "M  CHG" lines.
+    The atom index to charge mapping is built from the property block and only the atom lines that carry a charge
+    are rewritten (just the charge columns), so the molblock is processed in a single pass.
     See https://sourceforge.net/p/rdkit/mailman/message/36425493/
+
+    :param mb: The molblock, as generated by RDKit (header, counts line, atom block ...)
+    :return: The molblock with the charge flags set in the atom block
     """
-    f="{:>10s}"*3+"{:>2}{:>4s}"+"{:>3s}"*11
-    chgs = []    # list of charges
     lines = mb.split("\n")
-    if mb[0] == '' or mb[0] == "\n":
-        del lines[0]
-    CTAB = lines[2]
-    atomCount = int(CTAB.split()[0])
-    # parse mb line per line
-    for l in lines:
-        # look for M CHG property
-        if l[0:6] == "M  CHG":
-            records = l.split()[3:]    # M  CHG X is not needed for parsing, the info we want comes afterwards
-            # record each charge into a list
-            for i in range(0,len(records),2):
-                idx = records[i]
-                chg = records[i+1]
-                chgs.append((int(idx), int(chg)))    # sort tuples by first element?
-            break    # stop iterating
-
-    # sort by idx in order to parse the molblock only once more
-    chgs = sorted(chgs, key=lambda x: x[0])
-
-    # that we have a list for the current molblock, attribute each charges
-    for chg in chgs:
-        i=3
-        while i < 3+atomCount:    # do not read from beginning each time, rather continue parsing mb!
-            # when finding the idx of the atom we want to update, extract all fields and rewrite whole sequence
-            if i-2 == chg[0]:    # -4 to take into account the CTAB headers, +1 because idx begin at 1 and not 0
-                fields = lines[i].split()
-                x=fields[0]
-                y=fields[1]
-                z=fields[2]
-                symb=fields[3]
-                massDiff=fields[4]
-                charge=fields[5]
-                sp=fields[6]
-                hc=fields[7]
-                scb=fields[8]
-                v=fields[9]
-                hd=fields[10]
-                nu1=fields[11]
-                nu2=fields[12]
-                aamn=fields[13]
-                irf=fields[14]
-                ecf=fields[15]
-                # update charge flag
-                if chg[1] == -1:
-                    charge = '5'
-                elif chg[1] == -2:
-                    charge = '6'
-                elif chg[1] == -3:
-                    charge = '7'
-                elif chg[1] == 1:
-                    charge = '3'
-                elif chg[1] == 2:
-                    charge = '2'
-                elif chg[1] == 3:
-                    charge = '1'
-                else:
-                    print("ERROR! " + str(lines[0]) + "unknown charge flag: " + str(chg[1]))    # print name then go to next chg
-                    break
-                # update modatom block line
-                lines[i] = f.format(x,y,z,symb,massDiff,charge,sp,hc,scb,v,hd,nu1,nu2,aamn,irf,ecf)
-            i+=1
-    #print("\n".join(lines))
-    del lines[-1]    # remove empty element left because last character before $$$$ is \n
-    upmb = "\n" + "\n".join(lines)
-    return(upmb)
+    if len(lines) < 4 or 'V3000' in lines[3]:
+        return mb
+    atomCount = int(lines[3][0:3])
+
+    # map atom index to charge. There can be multiple M  CHG lines, each with up to 8 entries
+    chgs = {}
+    for l in lines[4 + atomCount:]:
+        if l.startswith("M  CHG"):
+            records = l.split()[3:]
+            for i in range(0, len(records) - 1, 2):
+                chgs[int(records[i])] = int(records[i + 1])
+        elif l.startswith("M  END"):
+            break
+
+    for idx, chg in chgs.items():
+        flag = legacy_charge_flags.get(chg)
+        if flag is None:
+            log("ERROR! " + lines[0] + " unknown charge flag: " + str(chg))
+            continue
+        # columns 37-39 of the atom line hold the charge code
+        i = 3 + idx
+        line = lines[i]
+        lines[i] = line[:36] + flag + line[39:]
+
+    return "\n".join(lines)
 
 
 def read_delimiter(input):
@@ -0,0 +1,53 @@
+import functools
+import http.server
+import pickle
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root / 'src'))
+
+
+@pytest.fixture(scope='session')
+def model_dir(tmp_path_factory):
+    """
+    Directory of .jmodel files built from the stand-in models.
+    """
+    import stand_in_models
+
+    directory = tmp_path_factory.mktemp('models')
+    for model_id, create in stand_in_models.models.items():
+        with open(directory / f'{model_id}.jmodel', 'wb') as out:
+            pickle.dump(create(), out)
+    return directory
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def model_url(model_dir):
+    """
+    URL of a local HTTP server in front of model_dir, standing in for the public models. The URL has a path, like
+    the URL of a bucket folder would.
+    """
+    handler = functools.partial(QuietHandler, directory=str(model_dir.parent))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/{model_dir.name}/'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_model_env(monkeypatch):
+    # the tests choose where the models come from
+    monkeypatch.delenv('BASE_MODEL_URL', raising=False)
+    monkeypatch.delenv('MODEL_CACHE_DIR', raising=False)
@@ -0,0 +1,52 @@
+"""
+Small stand-ins for the Jaqpot models, used to build .jmodel fixtures so that the tests can run without the public
+models. Like a jaqpotpy MolecularModel they are pickled, and calling them with a molecule sets the prediction,
+probability and doa attributes. The predictions are linear in a few RDKit descriptors so they are deterministic.
+"""
+
+import numpy as np
+from rdkit.Chem import Descriptors
+
+
+class StandInDoa:
+
+    def __init__(self, max_heavy_atoms):
+        self.max_heavy_atoms = max_heavy_atoms
+        self.IN = []
+
+
+class StandInModel:
+
+    def __init__(self, weights, classification=False, doa=None):
+        """
+        :param weights: Weights of the descriptors (MolLogP, TPSA, heavy atom count) and the bias
+        :param classification: Predict classes, with the probabilities from a logistic function
+        :param doa: The heavy atom count up to which molecules are in the domain of applicability, or None
+        """
+        self.weights = np.asarray(weights, dtype=float)
+        self.classification = classification
+        self.doa = StandInDoa(doa) if doa is not None else None
+        self.prediction = []
+        self.probability = []
+
+    def __call__(self, mol):
+        x = np.array([Descriptors.MolLogP(mol), Descriptors.TPSA(mol), mol.GetNumHeavyAtoms(), 1.0])
+        y = float(x @ self.weights)
+        if self.classification:
+            active = 1.0 / (1.0 + np.exp(-y))
+            self.prediction = [int(active >= 0.5)]
+            self.probability = [[1.0 - active, active]]
+        else:
+            self.prediction = [y]
+            self.probability = []
+        if self.doa is not None:
+            self.doa.IN = [mol.GetNumHeavyAtoms() <= self.doa.max_heavy_atoms]
+
+
+# model ID -> stand-in, covering regression and classification, with and without a domain of applicability
+models = {
+    'solubility': lambda: StandInModel([-0.8, 0.01, -0.05, 0.5]),
+    'lipophilicity': lambda: StandInModel([0.9, -0.005, 0.01, 0.1], doa=30),
+    'AMES': lambda: StandInModel([0.3, -0.02, 0.05, -1.0], classification=True),
+    'herg': lambda: StandInModel([0.5, -0.03, 0.04, -0.5], classification=True, doa=35),
+}
@@ -0,0 +1,114 @@
+"""
+Tests and a throughput benchmark of the deprecated charge codes written with --legacy-charges, on a generated library
+of large molecules with many charged atoms. The previous implementation is kept here to compare against.
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip('rdkit')
+
+from rdkit import Chem
+
+import utils
+
+# repeating units with a cation and an anion, chained to build molecules of increasing size
+units = ['CC([NH3+])CC(C(=O)[O-])', 'CC(C[N+](C)(C)C)CC(C([O-])=O)', 'c1ccc(cc1)CC([NH2+]C)CC(S(=O)(=O)[O-])']
+
+
+def library(max_units, repeats):
+    """
+    Generate the molblocks of the library, with all combinations of the units up to max_units long.
+    """
+    molblocks = []
+    for n in range(1, max_units + 1):
+        for i in range(len(units)):
+            smiles = ''.join([units[(i + j) % len(units)] for j in range(n)])
+            molblocks.append(Chem.MolToMolBlock(Chem.MolFromSmiles(smiles)))
+    return molblocks * repeats
+
+
+def old_update_charge_flag_in_atom_block(mb):
+    """
+    The previous implementation of utils.UpdateChargeFlagInAtomBlock, which rewrote the whole atom line, looping over
+    the atoms for each charge. It only reads the first "M  CHG" line (so at most 8 charges) and expects the molblock
+    to have an empty name.
+    """
+    f = "{:>10s}" * 3 + "{:>2}{:>4s}" + "{:>3s}" * 11
+    chgs = []
+    lines = mb.split("\n")
+    if mb[0] == '' or mb[0] == "\n":
+        del lines[0]
+    CTAB = lines[2]
+    atomCount = int(CTAB.split()[0])
+    for l in lines:
+        if l[0:6] == "M  CHG":
+            records = l.split()[3:]
+            for i in range(0, len(records), 2):
+                idx = records[i]
+                chg = records[i + 1]
+                chgs.append((int(idx), int(chg)))
+            break
+
+    chgs = sorted(chgs, key=lambda x: x[0])
+
+    for chg in chgs:
+        i = 3
+        while i < 3 + atomCount:
+            if i - 2 == chg[0]:
+                fields = lines[i].split()
+                charge = {-1: '5', -2: '6', -3: '7', 1: '3', 2: '2', 3: '1'}[chg[1]]
+                lines[i] = f.format(*fields[:5], charge, *fields[6:16])
+            i += 1
+    del lines[-1]
+    return "\n" + "\n".join(lines)
+
+
+def charge_columns(mb):
+    lines = mb.split("\n")
+    num_atoms = int(lines[3][0:3])
+    return [line[36:39] for line in lines[4:4 + num_atoms]]
+
+
+def expected_columns(mb):
+    mol = Chem.MolFromMolBlock(mb)
+    return [utils.legacy_charge_flags.get(atom.GetFormalCharge(), '  0') for atom in mol.GetAtoms()]
+
+
+def test_all_charges_flagged():
+    # the larger molecules have several "M  CHG" lines
+    for mb in library(12, 1):
+        updated = utils.UpdateChargeFlagInAtomBlock(mb)
+        assert charge_columns(updated) == expected_columns(mb)
+        # only the charge columns change
+        assert [line[:36] + line[39:] for line in updated.split("\n")] == \
+               [line[:36] + line[39:] for line in mb.split("\n")]
+        assert Chem.MolToSmiles(Chem.MolFromMolBlock(updated)) == Chem.MolToSmiles(Chem.MolFromMolBlock(mb))
+
+
+def test_same_as_old():
+    # up to 8 charges, which is all the old implementation handles
+    for mb in library(4, 1):
+        assert charge_columns(utils.UpdateChargeFlagInAtomBlock(mb)) == charge_columns(
+            old_update_charge_flag_in_atom_block(mb))
+
+
+def best_time(function, molblocks, repeats=5):
+    """The shortest of several timings, which is the least affected by other load on the machine"""
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for mb in molblocks:
+            function(mb)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def test_throughput():
+    molblocks = library(4, 50)
+    old_time = best_time(old_update_charge_flag_in_atom_block, molblocks)
+    new_time = best_time(utils.UpdateChargeFlagInAtomBlock, molblocks)
+    # the new implementation is about 2.5 times faster
+    assert new_time * 1.5 < old_time, f'{len(molblocks) / old_time:.0f} molblocks per second before, ' \
+                                      f'{len(molblocks) / new_time:.0f} now'
@@ -0,0 +1,175 @@
+"""
+Tests of the prediction runs using the stand-in models (see stand_in_models), covering the different places the
+models can be loaded from, the batched and memory mapped paths and the throughput.
+"""
+
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('rdkit')
+pytest.importorskip('jaqpotpy')
+pytest.importorskip('dm_job_utilities')
+
+import jaqpot
+
+data_dir = Path(__file__).resolve().parent.parent / 'data'
+
+model_ids = ['herg', 'AMES', 'solubility', 'lipophilicity']
+
+# minimum throughput on data/1000.smi with all the stand-in models, can be overridden for slow machines
+min_molecules_per_second = float(os.environ.get('JAQPOT_MIN_MOLECULES_PER_SECOND', 200))
+
+
+def predict(tmp_path, output='out.smi', input_file=data_dir / '1000.smi', models=model_ids, **kwargs):
+    output = tmp_path / output
+    kwargs.setdefault('read_header', False)
+    jaqpot.run(models, input_file if isinstance(input_file, list) else str(input_file), str(output), **kwargs)
+    with open(output) as f:
+        return f.read()
+
+
+def test_model_base_path_is_used(model_dir):
+    # the base path was overwritten with the public models URL
+    models = jaqpot.load_models(model_ids, str(model_dir))
+    assert list(models) == model_ids
+
+
+def test_base_model_url_env(model_dir, monkeypatch):
+    monkeypatch.setenv('BASE_MODEL_URL', str(model_dir))
+    assert list(jaqpot.load_models(model_ids, '')) == model_ids
+
+
+def test_model_base_path_overrides_env(model_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv('BASE_MODEL_URL', str(tmp_path))
+    assert list(jaqpot.load_models(model_ids, str(model_dir))) == model_ids
+    assert jaqpot.load_models(model_ids, '') == {}
+
+
+def test_missing_model(model_dir):
+    assert list(jaqpot.load_models(['herg', 'dili'], str(model_dir))) == ['herg']
+
+
+def test_model_types(model_dir, tmp_path):
+    header = predict(tmp_path, input_file=data_dir / '10.smi', model_base_path=str(model_dir)).splitlines()[0]
+    assert header.split('\t')[2:] == [
+        'hERG_model_Prediction', 'hERG_model_Inactive', 'hERG_model_Active', 'hERG_model_DOA',
+        'AMES_model_Prediction', 'AMES_model_Inactive', 'AMES_model_Active',
+        'Aqueous_solubility_model_Prediction',
+        'Lipophilicity_model_Prediction', 'Lipophilicity_model_DOA',
+    ]
+
+
+def test_base_paths(model_dir, model_url, tmp_path):
+    expected = predict(tmp_path, model_base_path=str(model_dir))
+    assert predict(tmp_path, model_base_path=model_dir.as_uri()) == expected
+    assert predict(tmp_path, model_base_path=model_url) == expected
+    # without the trailing slash urljoin would drop the last part of the path
+    assert predict(tmp_path, model_base_path=model_url.rstrip('/')) == expected
+
+
+def test_batch_size_and_mmap(model_dir, tmp_path):
+    expected = predict(tmp_path, model_base_path=str(model_dir), batch_size=1)
+    assert len(expected.splitlines()) == 1001
+    assert predict(tmp_path, model_base_path=str(model_dir)) == expected
+    assert predict(tmp_path, model_base_path=str(model_dir), mmap_models=True) == expected
+    assert os.path.exists(model_dir / 'herg.jmodel.joblib')
+    # and again from the existing memory mappable files
+    assert predict(tmp_path, model_base_path=str(model_dir), mmap_models=True) == expected
+
+
+def test_mmap_url_models(model_dir, model_url, tmp_path):
+    expected = predict(tmp_path, model_base_path=str(model_dir))
+    cache_dir = tmp_path / 'cache'
+    assert predict(tmp_path, model_base_path=model_url, mmap_models=True) == expected
+    assert predict(tmp_path, model_base_path=model_url, mmap_models=True, model_cache_dir=str(cache_dir)) == expected
+    assert sorted(os.listdir(cache_dir)) == sorted(f'{model_id}.jmodel.joblib' for model_id in model_ids)
+    assert predict(tmp_path, model_base_path=model_url, mmap_models=True, model_cache_dir=str(cache_dir)) == expected
+
+
+@pytest.mark.parametrize('options', [{}, {'batch_size': 1}, {'mmap_models': True}])
+def test_throughput(model_dir, tmp_path, options):
+    t0 = time.time()
+    predict(tmp_path, model_base_path=str(model_dir), **options)
+    rate = 1000 / (time.time() - t0)
+    assert rate >= min_molecules_per_second, f'{rate:.1f} molecules per second'
+
+
+def test_append_concatenated(model_dir, tmp_path):
+    first = tmp_path / 'first.smi'
+    second = tmp_path / 'second.smi'
+    predict(tmp_path, first, input_file=data_dir / '10.smi', models=['herg'], model_base_path=str(model_dir))
+    predict(tmp_path, second, input_file=data_dir / '1000.smi', models=['herg'], model_base_path=str(model_dir))
+    lines = predict(tmp_path, input_file=[str(first), str(second)], models=['herg', 'AMES'], append=True,
+                    model_base_path=str(model_dir)).splitlines()
+    assert len(lines) == 1011
+    assert lines[0].split('\t')[1:] == [
+        'field2', 'hERG_model_Prediction', 'hERG_model_Inactive', 'hERG_model_Active', 'hERG_model_DOA',
+        'AMES_model_Prediction', 'AMES_model_Inactive', 'AMES_model_Active', 'source_file',
+    ]
+
+
+def test_append_different_fields(model_dir, tmp_path):
+    first = tmp_path / 'first.smi'
+    second = tmp_path / 'second.smi'
+    predict(tmp_path, first, input_file=data_dir / '10.smi', models=['herg'], model_base_path=str(model_dir))
+    predict(tmp_path, second, input_file=data_dir / '10.smi', models=['AMES', 'solubility'],
+            model_base_path=str(model_dir))
+    # the header lines are read, so the different predictions are found rather than just the number of columns
+    with pytest.raises(ValueError, match='different fields'):
+        predict(tmp_path, input_file=[str(first), str(second)], models=['lipophilicity'], append=True,
+                model_base_path=str(model_dir))
+
+
+def test_duplicate_output_names(model_dir, tmp_path):
+    for directory in ('a', 'b'):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / 'x.smi').write_text((data_dir / '10.smi').read_text())
+    with pytest.raises(ValueError, match='would both be written to'):
+        predict(tmp_path, '{name}.smi', input_file=[str(tmp_path / 'a' / 'x.smi'), str(tmp_path / 'b' / 'x.smi')],
+                model_base_path=str(model_dir))
+    assert not (tmp_path / 'x.smi').exists()
+
+
+def test_unmatched_pattern(model_dir, tmp_path, capsys):
+    lines = predict(tmp_path, input_file=[str(data_dir / '10.smi'), str(tmp_path / 'missing*.smi')],
+                    model_base_path=str(model_dir)).splitlines()
+    assert len(lines) == 11
+    assert f'No files match {tmp_path}/missing*.smi' in capsys.readouterr().out
+
+
+def test_header_after_filtered_input(model_dir, tmp_path):
+    # split the molecules by their hERG prediction
+    lines = predict(tmp_path, models=['herg'], model_base_path=str(model_dir)).splitlines()[1:]
+    failing = ['\t'.join(line.split('\t')[:2]) + '\n' for line in lines if line.split('\t')[2] != '0']
+    passing = ['\t'.join(line.split('\t')[:2]) + '\n' for line in lines if line.split('\t')[2] == '0']
+    first = tmp_path / 'first.smi'
+    second = tmp_path / 'second.smi'
+    first.write_text(''.join(failing[:5]))
+    second.write_text(''.join(failing[5:10] + passing[:5]))
+
+    # none of the molecules of the first input pass the filter, the header is written with those of the second
+    lines = predict(tmp_path, input_file=[str(first), str(second)], filters=['herg_Prediction == 0'],
+                    model_base_path=str(model_dir)).splitlines()
+    assert len(lines) == 6
+    assert lines[0].startswith('smiles\t')
+
+
+def test_unknown_filter_column(model_dir, tmp_path):
+    with pytest.raises(ValueError, match='unknown columns hERG_model_Foo'):
+        predict(tmp_path, 'bad.smi', filters=['herg_Foo == 1'], model_base_path=str(model_dir))
+    assert not (tmp_path / 'bad.smi').exists()
+
+
+def test_estimate_memory(model_dir, tmp_path):
+    models = jaqpot.load_models(model_ids, str(model_dir))
+    kwargs = dict(sample_size=100, delimiter='\t', read_header=False)
+    output = str(tmp_path / 'out.smi')
+    small = jaqpot.estimate(models, [str(data_dir / '1000.smi')], output, 0, batch_size=1, **kwargs)
+    assert small['peak_memory_mb'] >= small['sample_peak_memory_mb']
+    # the top-k records are held in memory
+    large = jaqpot.estimate(models, [str(data_dir / '1000.smi')], output, 0, batch_size=1, top_k=1000, **kwargs)
+    assert large['peak_memory_mb'] - large['sample_peak_memory_mb'] > \
+           small['peak_memory_mb'] - small['sample_peak_memory_mb']
@@ -0,0 +1,49 @@
+"""
+Tests of the readers, comparing the records read through RDKit with those read from the text of the SD records
+(keep_raw), which is used when the records are passed through to SDF outputs.
+"""
+
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('rdkit')
+pytest.importorskip('dm_job_utilities')
+
+import rdkit_utils
+
+data_dir = Path(__file__).resolve().parent.parent / 'data'
+
+
+def read_all(filename, keep_raw):
+    reader = rdkit_utils.SdfReader(str(filename), None, 100, keep_raw=keep_raw)
+    records = []
+    try:
+        while True:
+            try:
+                records.append(reader.read())
+            except rdkit_utils.RecordError:
+                records.append(None)
+            except StopIteration:
+                break
+    finally:
+        reader.close()
+    return [(record.smiles, record.props) if record else None for record in records]
+
+
+@pytest.mark.parametrize('ending', ['$$$$\n', '', '\n', '\n\n'])
+def test_raw_records(tmp_path, ending):
+    text = (data_dir / 'candidates-10.sdf').read_text()
+    assert text.endswith('$$$$\n')
+    # with and without the final $$$$ line, and with the last item not ended with a blank line
+    filename = tmp_path / 'input.sdf'
+    filename.write_text(text[:-len('$$$$\n')].rstrip('\n') + ending)
+
+    expected = read_all(filename, keep_raw=False)
+    assert len(expected) == 10
+    assert read_all(filename, keep_raw=True) == expected
+
+
+def test_raw_records_with_errors():
+    filename = data_dir / 'candidates-10-error.sdf'
+    assert read_all(filename, keep_raw=True) == read_all(filename, keep_raw=False)
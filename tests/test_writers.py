@@ -0,0 +1,43 @@
+"""
+Tests of the column types written by the ColumnarWriter.
+"""
+
+import pytest
+
+pytest.importorskip('rdkit')
+pytest.importorskip('dm_job_utilities')
+pa = pytest.importorskip('pyarrow')
+
+import pyarrow.parquet
+
+import rdkit_utils
+
+names = ['smiles', 'id', 'hERG_model_Prediction', 'hERG_model_Inactive', 'hERG_model_Active', 'hERG_model_DOA',
+         'Aqueous_solubility_model_Prediction']
+
+
+def write(filename, format):
+    writer = rdkit_utils.ColumnarWriter(str(filename), format, chunk_size=2)
+    writer.write_header(names)
+    # the first chunk has no predictions, as if the models could not be applied
+    writer.write_batch([('C', None, None, ['1'], [None] * 5, None)] * 2)
+    writer.write_batch([('CC', None, None, ['2'], [1, 0.3, 0.7, True, -2.5], None),
+                        ('CCC', None, None, ['3'], [0, 0.8, 0.2, False, None], None)])
+    writer.close()
+
+
+def test_parquet_types(tmp_path):
+    write(tmp_path / 'out.parquet', 'parquet')
+    table = pa.parquet.read_table(tmp_path / 'out.parquet')
+    assert [field.type for field in table.schema] == [
+        pa.string(), pa.string(), pa.int64(), pa.float64(), pa.float64(), pa.bool_(), pa.float64()]
+    assert table.column('hERG_model_Prediction').to_pylist() == [None, None, 1, 0]
+    assert table.column('Aqueous_solubility_model_Prediction').to_pylist() == [None, None, -2.5, None]
+
+
+def test_csv_classes(tmp_path):
+    write(tmp_path / 'out.csv', 'csv')
+    lines = (tmp_path / 'out.csv').read_text().splitlines()
+    assert lines[0] == ','.join(names)
+    assert lines[3] == 'CC,2,1,0.3,0.7,True,-2.5'
+    assert lines[4] == 'CCC,3,0,0.8,0.2,False,'